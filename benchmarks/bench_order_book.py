@@ -0,0 +1,306 @@
+# Нагрузочный замер стакана без экрана: синтетические 50-уровневые стаканы акций и фьючерсов,
+# растущее число одновременных стаканов и ширина лестницы (шаг между уровнями в тиках).
+# Замеряются:
+#   build               — LadderBuilder.build (то, что шард стрима делает на каждое сообщение)
+#   update_order_book   — OrderBookWindow.update_order_book (снимок, переданный напрямую)
+#   update_first_column — переключение объём/сумма: update_first_column и перерисовка
+#   update_from_buffer  — кадр планировщика: _update_from_buffer по накопленным событиям и перерисовка
+# Время кадра включает синхронную перерисовку таблицы (viewport().repaint()), где она есть.
+# Обновление — кадр, применённый в одном окне; событие — стакан или сделка, принятые окном
+# (в update_from_buffer на кадр приходится несколько событий, в остальных замерах одно).
+# Результат — JSON: обновлений и событий в секунду, p50/p99 времени кадра, память и число
+# блоков на обновление (tracemalloc).
+#
+#   QT_QPA_PLATFORM=offscreen python benchmarks/bench_order_book.py -o bench.json
+#   QT_QPA_PLATFORM=offscreen python benchmarks/bench_order_book.py -o new.json --compare bench.json
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtCore import QT_VERSION_STR, PYQT_VERSION_STR
+from PyQt5.QtWidgets import QApplication
+from order_book_copy import LadderBuilder, OrderBookWindow, TradeTick
+from prices import NANO
+
+DEPTH = 50
+# Инструмент: шаг цены (нано), лот, цена около (нано)
+INSTRUMENTS = {
+    'share': (NANO // 100, 10, 250 * NANO),      # акция TQBR: шаг 0.01
+    'future': (NANO, 1, 90_000 * NANO),          # фьючерс SPBFUT: шаг 1
+}
+SNAPSHOTS = 256  # разных синтетических снимков на стакан, дальше по кругу
+EVENTS_PER_FRAME = 4  # стаканов, накопленных к кадру планировщика (плюс столько же сделок)
+ALLOC_SAMPLES = 20
+
+def synthetic_books(step, lot, price, gap, count, seed):
+    # Снимки 50x50 уровней: середина случайно гуляет на тик, объёмы случайные,
+    # между соседними уровнями gap тиков (ширина лестницы ~ 2 * DEPTH * gap строк)
+    rng = random.Random(seed)
+    mid = price // step
+    books = []
+    for _ in range(count):
+        mid += rng.choice((-1, 0, 0, 1))
+        bids = [((mid - i * gap) * step, rng.randint(1, 500) * lot, 0) for i in range(DEPTH)]
+        asks = [((mid + 1 + i * gap) * step, rng.randint(1, 500) * lot, 0) for i in range(DEPTH)]
+        books.append((bids, asks))
+    return books
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(durations, events_per_update):
+    # Одна длительность — одно обновление (кадр окна)
+    total = sum(durations)
+    ordered = sorted(durations)
+    updates = len(durations)
+    events = updates * events_per_update
+    return {
+        'updates': updates,
+        'updates_per_sec': round(updates / total, 1) if total else None,
+        'events': events,
+        'events_per_sec': round(events / total, 1) if total else None,
+        'frame_ms_p50': round(percentile(ordered, 0.50) * 1000, 4),
+        'frame_ms_p99': round(percentile(ordered, 0.99) * 1000, 4),
+    }
+
+def traced_snapshot():
+    # Снимок tracemalloc без блоков самого tracemalloc (снимки, статистика)
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+def measure_memory(step_fn, prepare_fn, updates_per_step):
+    # Пик памяти на обновление (временные объекты) и блоки, пережившие шаг, по снимкам
+    # tracemalloc до и после шага: allocated — новые блоки по строкам выделения,
+    # retained — чистый прирост блоков (утечки, кэши). prepare_fn выполняется вне замера;
+    # если шаг освобождает подготовленный вход (события буфера), прирост бывает отрицательным.
+    tracemalloc.start()
+    try:
+        prepare_fn()
+        step_fn()  # прогрев: ленивые структуры не считаются
+        peaks = []
+        retained = 0
+        allocated = 0
+        retained_blocks = 0
+        for _ in range(ALLOC_SAMPLES):
+            prepare_fn()
+            before = traced_snapshot()
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            step_fn()
+            current_after, peak = tracemalloc.get_traced_memory()
+            diff = traced_snapshot().compare_to(before, 'lineno')
+            allocated += sum(stat.count_diff for stat in diff if stat.count_diff > 0)
+            retained_blocks += sum(stat.count_diff for stat in diff)
+            peaks.append(peak - current)
+            retained += current_after - current
+    finally:
+        tracemalloc.stop()
+    updates = ALLOC_SAMPLES * updates_per_step
+    peaks.sort()
+    return {
+        'peak_kib_per_update_p50': round(percentile(peaks, 0.50) / updates_per_step / 1024, 2),
+        'retained_bytes_per_update': round(retained / updates, 1),
+        'allocated_blocks_per_update': round(allocated / updates, 2),
+        'retained_blocks_per_update': round(retained_blocks / updates, 2),
+    }
+
+class Scenario:
+    # Набор окон одного инструмента и ширины лестницы и их синтетические снимки
+    def __init__(self, app, instrument, books, gap, seed):
+        self.app = app
+        self.step, self.lot, price = INSTRUMENTS[instrument]
+        self.windows = []
+        self.builders = []
+        self.snapshots = []
+        for i in range(books):
+            window = OrderBookWindow()
+            window.price_step_nanos = self.step
+            window.lot_size = self.lot
+            window.resize(320, 900)
+            window.show()
+            self.windows.append(window)
+            self.builders.append(LadderBuilder(self.step, self.lot))
+            self.snapshots.append(synthetic_books(self.step, self.lot, price, gap, SNAPSHOTS, seed + i))
+        self.tick = 0
+        app.processEvents()
+        self.rows = self._prime()
+
+    def _prime(self):
+        for window, snapshots in zip(self.windows, self.snapshots):
+            window.update_order_book(*snapshots[0])
+        self.app.processEvents()
+        return max(window.model.rowCount() for window in self.windows)
+
+    def close(self):
+        for window in self.windows:
+            window.close()
+            window.deleteLater()
+        self.app.processEvents()
+
+    def next_books(self):
+        self.tick += 1
+        return [snapshots[self.tick % SNAPSHOTS] for snapshots in self.snapshots]
+
+    # --- Шаги: один вызов = одно обновление каждого стакана ---
+    def step_build(self, timings=None):
+        for builder, (bids, asks) in zip(self.builders, self.next_books()):
+            started = time.perf_counter()
+            builder.build(builder.snapshot.set_levels(bids, asks))
+            if timings is not None:
+                timings.append(time.perf_counter() - started)
+
+    def step_update_order_book(self, timings=None):
+        for window, (bids, asks) in zip(self.windows, self.next_books()):
+            started = time.perf_counter()
+            window.update_order_book(bids, asks)
+            window.table.viewport().repaint()
+            if timings is not None:
+                timings.append(time.perf_counter() - started)
+
+    def step_update_first_column(self, timings=None):
+        self.tick += 1
+        for window in self.windows:
+            started = time.perf_counter()
+            window.volume_mode = not window.volume_mode
+            window.model.set_volume_mode(window.volume_mode)
+            window.update_first_column()
+            window.table.viewport().repaint()
+            if timings is not None:
+                timings.append(time.perf_counter() - started)
+
+    def prepare(self):
+        pass
+
+    def fill_buffers(self):
+        # Как поток стрима: кадры строятся заранее и попадают в буфер событий окна
+        for window, builder, snapshots in zip(self.windows, self.builders, self.snapshots):
+            for _ in range(EVENTS_PER_FRAME):
+                self.tick += 1
+                bids, asks = snapshots[self.tick % SNAPSHOTS]
+                frame = builder.build(builder.snapshot.set_levels(bids, asks))
+                window._events.append(frame)
+                window._events.append(TradeTick(bids[0][0], 1, 1))
+
+    def step_update_from_buffer(self, timings=None):
+        for window in self.windows:
+            started = time.perf_counter()
+            window.render_pending()
+            window.table.viewport().repaint()
+            if timings is not None:
+                timings.append(time.perf_counter() - started)
+
+BENCHES = {
+    # имя: (шаг, подготовка вне замера, событий, принятых окном за одно обновление)
+    'build': ('step_build', 'prepare', 1),
+    'update_order_book': ('step_update_order_book', 'prepare', 1),
+    'update_first_column': ('step_update_first_column', 'prepare', 1),
+    'update_from_buffer': ('step_update_from_buffer', 'fill_buffers', 2 * EVENTS_PER_FRAME),  # стаканы и сделки
+}
+
+def run_bench(app, bench, instrument, books, gap, rounds, seed):
+    scenario = Scenario(app, instrument, books, gap, seed)
+    method, prepare_method, events_per_update = BENCHES[bench]
+    step = getattr(scenario, method)
+    prepare = getattr(scenario, prepare_method)
+    try:
+        for _ in range(min(20, rounds)):
+            prepare()
+            step()
+        timings = []
+        for _ in range(rounds):
+            prepare()
+            step(timings)
+        # Время кадра и обновление — одно окно за вызов; события — всё, что окно приняло к кадру
+        result = summarize(timings, events_per_update)
+        result.update(measure_memory(step, prepare, books))
+    finally:
+        scenario.close()
+    result.update({'bench': bench, 'instrument': instrument, 'books': books, 'level_gap': gap,
+                   'ladder_rows': scenario.rows})
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def result_key(result):
+    return (result['bench'], result['instrument'], result['books'], result['level_gap'])
+
+def compare(results, baseline_path):
+    # Отношение к базовому прогону: > 1 — стало медленнее
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    print(f"{'bench':<22}{'instr':<8}{'books':>6}{'gap':>5}{'p50 x':>9}{'p99 x':>9}{'upd/s x':>9}")
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        ratios = [result[k] / base[k] if base[k] else float('nan') for k in ('frame_ms_p50', 'frame_ms_p99')]
+        ratios.append(base['updates_per_sec'] / result['updates_per_sec'] if result['updates_per_sec'] else float('nan'))
+        print(f"{result['bench']:<22}{result['instrument']:<8}{result['books']:>6}{result['level_gap']:>5}"
+              + ''.join(f"{r:>9.2f}" for r in ratios))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Замер производительности стакана (offscreen)")
+    parser.add_argument('-o', '--output', help="JSON с результатами (по умолчанию stdout)")
+    parser.add_argument('--bench', action='append', choices=sorted(BENCHES), help="какие замеры (по умолчанию все)")
+    parser.add_argument('--instrument', action='append', choices=sorted(INSTRUMENTS))
+    parser.add_argument('--books', type=int, nargs='+', default=[1, 4, 16], help="число одновременных стаканов")
+    parser.add_argument('--gaps', type=int, nargs='+', default=[1, 4, 16], help="тиков между уровнями (ширина лестницы)")
+    parser.add_argument('--rounds', type=int, default=100, help="обновлений на стакан в замере")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compare', metavar='BASELINE', help="сравнить с JSON прошлого прогона")
+    args = parser.parse_args(argv[1:])
+    app = QApplication.instance() or QApplication(argv[:1])
+    results = []
+    for bench in args.bench or list(BENCHES):
+        for instrument in args.instrument or list(INSTRUMENTS):
+            for books in args.books:
+                for gap in args.gaps:
+                    result = run_bench(app, bench, instrument, books, gap, args.rounds, args.seed)
+                    results.append(result)
+                    print(f"[bench] {bench} {instrument} books={books} rows={result['ladder_rows']}: "
+                          f"{result['updates_per_sec']} upd/s, {result['events_per_sec']} events/s, "
+                          f"p50 {result['frame_ms_p50']} ms, "
+                          f"p99 {result['frame_ms_p99']} ms", file=sys.stderr)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'pyqt': PYQT_VERSION_STR,
+            'platform': platform.platform(),
+            'qpa': os.environ.get('QT_QPA_PLATFORM'),
+            'depth': DEPTH,
+            'rounds': args.rounds,
+            'events_per_frame': EVENTS_PER_FRAME,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,124 @@
+# Общие подключения к API на весь процесс.
+# Канал gRPC (AsyncClient) открывается один раз и живёт, пока жив процесс: TLS-рукопожатие
+# и установка соединения не повторяются на каждый REST-запрос или переподключение стрима.
+# Канал привязан к event loop'у, в котором создан, поэтому подключения разложены по «полосам»
+# (Lane): у каждой полосы свой поток, свой цикл и один канал на токен. REST-запросы окон
+# и стрим портфеля идут по полосе DEFAULT_LANE, у каждого шарда стаканов своя полоса.
+import asyncio
+import random
+import threading
+try:
+    from tinkoff.invest import AsyncClient
+except ImportError:
+    AsyncClient = None
+
+DEFAULT_LANE = "default"
+
+def reconnect_delay(attempt, base, maximum):
+    # Задержка перед попыткой переподключения, секунды: экспоненциальный рост от base до maximum
+    # и джиттер на вторую половину, чтобы стримы после общего обрыва не переподключались разом
+    delay = min(maximum, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class Lane:
+    # Поток с event loop'ом и одним долгоживущим AsyncClient для токена.
+    # Корутины запускаются через submit (из любого потока), сервисы API берутся через services()
+    # уже внутри цикла полосы.
+    def __init__(self, token, name):
+        self.token = token
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.connects = 0
+        self._client = None
+        self._services = None
+        self._lock = None
+        self.thread = threading.Thread(target=self._run, name=f"api-{name}", daemon=True)
+        self.thread.start()
+
+    @property
+    def connected(self):
+        return self._services is not None
+
+    def submit(self, coro):
+        # -> concurrent.futures.Future; cancel() у него отменяет корутину в цикле полосы
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def services(self):
+        # Сервисы API поверх общего канала; канал открывается при первом обращении
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._services is None:
+                if AsyncClient is None:
+                    raise RuntimeError("tinkoff.invest не установлен")
+                client = AsyncClient(self.token)
+                self._services = await client.__aenter__()
+                self._client = client
+                self.connects += 1
+            return self._services
+
+    async def reset(self):
+        # Закрыть канал (например, после мёртвого соединения); следующий services() откроет новый
+        client = self._client
+        self._client = None
+        self._services = None
+        if client is not None:
+            try:
+                await client.__aexit__(None, None, None)
+            except Exception:
+                pass
+
+    def close(self, timeout=2):
+        if not self.loop.is_running():
+            return
+        try:
+            self.submit(self.reset()).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def stats(self):
+        return {'lane': self.name, 'connected': self.connected, 'connects': self.connects}
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+class ConnectionPool:
+    # Реестр полос на процесс: (токен, имя полосы) -> Lane
+    _lanes = {}
+    _guard = threading.Lock()
+
+    @classmethod
+    def lane(cls, token, name=DEFAULT_LANE):
+        with cls._guard:
+            lane = cls._lanes.get((token, name))
+            if lane is None:
+                lane = cls._lanes[(token, name)] = Lane(token, name)
+            return lane
+
+    @classmethod
+    def release(cls, token, name):
+        # Закрыть полосу, которая больше не нужна (например, шард без подписок)
+        with cls._guard:
+            lane = cls._lanes.pop((token, name), None)
+        if lane is not None:
+            lane.close()
+
+    @classmethod
+    def close_all(cls):
+        with cls._guard:
+            lanes = list(cls._lanes.values())
+            cls._lanes.clear()
+        for lane in lanes:
+            lane.close()
+
+    @classmethod
+    def stats(cls):
+        with cls._guard:
+            return [lane.stats() for lane in cls._lanes.values()]
@@ -0,0 +1,94 @@
+# Дисковый кэш справочника инструментов.
+# Хранятся только нужные дашборду поля, компактно (JSON со списком строк) и с версией формата.
+# Кэш читается за миллисекунды при авторизации; устаревший (старше CACHE_TTL) используется сразу,
+# а свежий справочник догружается в фоне (main.AuthWorker) и подменяет его.
+import json
+import os
+import time
+from paths import cache_dir
+from prices import quotation_to_nanos
+
+CACHE_VERSION = 1
+CACHE_TTL = 24 * 60 * 60  # секунды
+CLASS_CODES = ("TQBR", "SPBFUT")
+FIELDS = ('ticker', 'class_code', 'figi', 'lot', 'min_price_increment', 'api_trade_available_flag')
+
+class InstrumentInfo:
+    # Инструмент из справочника; min_price_increment — шаг цены в нано (см. prices.py)
+    __slots__ = FIELDS
+
+    def __init__(self, ticker, class_code, figi, lot, min_price_increment, api_trade_available_flag):
+        self.ticker = ticker
+        self.class_code = class_code
+        self.figi = figi
+        self.lot = lot
+        self.min_price_increment = min_price_increment
+        self.api_trade_available_flag = api_trade_available_flag
+
+    @classmethod
+    def from_api(cls, inst):
+        return cls(inst.ticker, inst.class_code, inst.figi, int(getattr(inst, 'lot', 1) or 1),
+                   quotation_to_nanos(getattr(inst, 'min_price_increment', None)),
+                   bool(inst.api_trade_available_flag))
+
+    def as_row(self):
+        return [getattr(self, field) for field in FIELDS]
+
+    def __eq__(self, other):
+        return isinstance(other, InstrumentInfo) and self.as_row() == other.as_row()
+
+    def __hash__(self):
+        return hash(self.figi)
+
+def cache_path():
+    return cache_dir('instruments.json')
+
+def load_cache(path=None):
+    # (инструменты, время сохранения) или None, если кэша нет, он повреждён или другой версии
+    path = path or cache_path()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != CACHE_VERSION or data.get('fields') != list(FIELDS):
+            return None
+        return [InstrumentInfo(*row) for row in data['rows']], float(data['saved_at'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_cache(instruments, path=None):
+    # Запись через временный файл: читатель никогда не увидит недописанный кэш
+    path = path or cache_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {
+        'version': CACHE_VERSION,
+        'saved_at': time.time(),
+        'fields': list(FIELDS),
+        'rows': [inst.as_row() for inst in instruments],
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def is_expired(saved_at, ttl=CACHE_TTL):
+    return time.time() - saved_at > ttl
+
+def select_instruments(instruments):
+    # Только площадки дашборда и инструменты, доступные для торговли через API
+    return [InstrumentInfo.from_api(inst) for inst in instruments
+            if inst.class_code in CLASS_CODES and inst.api_trade_available_flag]
+
+def build_ticker_map(instruments):
+    # -> (отсортированные площадки, {(тикер, площадка): InstrumentInfo})
+    ticker_map = {(inst.ticker, inst.class_code): inst for inst in instruments}
+    class_codes = sorted({inst.class_code for inst in instruments})
+    return class_codes, ticker_map
+
+def build_ticker_index(instruments):
+    # -> {площадка: отсортированные тикеры}; строится один раз на загрузку справочника
+    index = {}
+    for inst in instruments:
+        index.setdefault(inst.class_code, []).append(inst.ticker)
+    for tickers in index.values():
+        tickers.sort()
+    return index
@@ -0,0 +1,201 @@
+# Задержки конвейера стакана: от времени биржи до применения кадра в окне.
+# Метки ставятся по ходу сообщения (LatencyStamps едет вместе с кадром или сделкой):
+#   exchange  — time из orderbook/trade биржи (часы биржи)
+#   received  — сообщение пришло в поток шарда (MarketDataShard._read_stream)
+#   emitted   — кадр собран и отправлен в окно (data_from_stream)
+#   picked_up — окно забрало событие из буфера (_update_from_buffer)
+#   applied   — кадр применён к модели, сделки разобраны
+# Участки: network = received - exchange (по настенным часам, включает рассинхрон часов),
+# decode = emitted - received, queue = picked_up - emitted (очередь Qt и ожидание кадра
+# RenderScheduler), render = applied - picked_up, total = network + applied - received.
+# Пока трекер выключен, метки не создаются: цена — одна проверка флага на сообщение.
+# Включается оверлеем стакана (Ctrl+L; Ctrl+Shift+L — выгрузка в JSON) или main.py --latency.
+import json
+import os
+import time
+from array import array
+from bisect import bisect_left
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QLabel
+from paths import data_dir
+
+STAGES = ('network', 'decode', 'queue', 'render', 'total')
+
+class LatencyStamps:
+    __slots__ = ('exchange_ns', 'received_wall_ns', 'received', 'emitted', 'picked_up')
+
+    def __init__(self):
+        # Монотонные метки в нс (time.monotonic_ns); создаётся в момент получения сообщения
+        self.exchange_ns = None
+        self.received_wall_ns = time.time_ns()
+        self.received = time.monotonic_ns()
+        self.emitted = 0
+        self.picked_up = 0
+
+    def set_exchange_time(self, exchange_time):
+        # Время биржи — datetime из API
+        if exchange_time is not None:
+            self.exchange_ns = int(exchange_time.timestamp() * 1e9)
+
+class RollingHistogram:
+    # Гистограмма последних WINDOW значений (мс) в логарифмических корзинах: при добавлении
+    # нового значения самое старое вычитается, процентили считаются по корзинам
+    WINDOW = 2048
+    BOUNDS = tuple(round(0.01 * 2 ** (i / 2), 4) for i in range(42))  # 0.01 мс .. ~10 с
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.values = array('d')
+        self.position = 0
+        self.total = 0
+
+    def add(self, value):
+        values = self.values
+        if len(values) < self.WINDOW:
+            values.append(value)
+        else:
+            old = values[self.position]
+            self.counts[bisect_left(self.BOUNDS, old)] -= 1
+            values[self.position] = value
+            self.position = (self.position + 1) % self.WINDOW
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.total += 1
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def max(self):
+        return max(self.values, default=0.0)
+
+    def percentile(self, q):
+        # Верхняя граница корзины, в которую попадает q-я доля окна (не больше максимума)
+        count = len(self.values)
+        if not count:
+            return None
+        target = q * count
+        seen = 0
+        largest = self.max
+        for i, bucket in enumerate(self.counts):
+            seen += bucket
+            if seen >= target and bucket:
+                return min(self.BOUNDS[i], largest) if i < len(self.BOUNDS) else largest
+        return largest
+
+    def summary(self):
+        return {
+            'count': len(self.values),
+            'total': self.total,
+            'p50_ms': self.percentile(0.50),
+            'p90_ms': self.percentile(0.90),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max, 3),
+            'buckets': [[bound, count] for bound, count in zip(self.BOUNDS + (None,), self.counts) if count],
+        }
+
+class BookLatency:
+    # Гистограммы участков одного стакана; обновляются только в GUI-потоке
+    def __init__(self):
+        self.stages = {stage: RollingHistogram() for stage in STAGES}
+
+    def add(self, stamps, applied):
+        stages = self.stages
+        if stamps.exchange_ns is not None:
+            network = (stamps.received_wall_ns - stamps.exchange_ns) / 1e6
+            stages['network'].add(network)
+            stages['total'].add(network + (applied - stamps.received) / 1e6)
+        stages['decode'].add((stamps.emitted - stamps.received) / 1e6)
+        stages['queue'].add((stamps.picked_up - stamps.emitted) / 1e6)
+        stages['render'].add((applied - stamps.picked_up) / 1e6)
+
+class LatencyTracker:
+    # Общий на процесс трекер: enabled читают потоки шардов, гистограммы ведёт GUI-поток.
+    # Включён, пока есть хотя бы один пользователь (открытый оверлей, флаг --latency).
+    def __init__(self):
+        self.enabled = False
+        self.books = {}  # figi: BookLatency
+        self._users = 0
+
+    def acquire(self):
+        self._users += 1
+        self.enabled = True
+
+    def release(self):
+        self._users = max(0, self._users - 1)
+        self.enabled = self._users > 0
+
+    def record(self, figi, stamped, picked_up, applied):
+        # События, забранные за один кадр окна: picked_up и applied у них общие
+        book = self.books.get(figi)
+        if book is None:
+            book = self.books[figi] = BookLatency()
+        for stamps in stamped:
+            stamps.picked_up = picked_up
+            book.add(stamps, applied)
+
+    def reset(self):
+        self.books.clear()
+
+    def export(self):
+        return {
+            'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'window': RollingHistogram.WINDOW,
+            'books': {figi: {stage: hist.summary() for stage, hist in book.stages.items()}
+                      for figi, book in self.books.items()},
+        }
+
+    def export_file(self, path=None):
+        path = path or os.path.join(data_dir(), time.strftime('latency-%Y%m%d-%H%M%S.json'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.export(), f, ensure_ascii=False, indent=2)
+        return path
+
+    def overlay_text(self, figi):
+        book = self.books.get(figi)
+        lines = [f"{'участок':<8}{'p50':>8}{'p99':>8}{'max':>9}{'n':>6}  мс"]
+        for stage in STAGES:
+            hist = book.stages[stage] if book is not None else None
+            if not hist:
+                lines.append(f"{stage:<8}{'—':>8}{'—':>8}{'—':>9}{0:>6}")
+                continue
+            lines.append(f"{stage:<8}{hist.percentile(0.5):>8.2f}{hist.percentile(0.99):>8.2f}"
+                         f"{hist.max:>9.2f}{len(hist):>6}")
+        return "\n".join(lines)
+
+TRACKER = LatencyTracker()
+
+class LatencyOverlay(QLabel):
+    # Полупрозрачная таблица задержек поверх стакана; пока включена, трекер собирает метки
+    REFRESH_INTERVAL = 500  # мс
+
+    def __init__(self, book_window):
+        super().__init__(book_window)
+        self.book_window = book_window
+        self.active = False
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet("background: rgba(16, 16, 16, 210); color: #9fd0ff; "
+                           "font-family: Consolas, monospace; font-size: 11px; padding: 4px;")
+        self._timer = QTimer(self)
+        self._timer.setInterval(self.REFRESH_INTERVAL)
+        self._timer.timeout.connect(self.refresh)
+        self.hide()
+
+    def toggle(self):
+        self.active = not self.active
+        if self.active:
+            TRACKER.acquire()
+            self.refresh()
+            self.show()
+            self.raise_()
+            self._timer.start()
+        else:
+            self._timer.stop()
+            self.hide()
+            TRACKER.release()
+
+    def refresh(self):
+        figi = self.book_window.figi
+        self.setText(f"{figi or '—'}\n{TRACKER.overlay_text(figi)}")
+        self.adjustSize()
+        self.move(4, self.book_window.height() - self.height() - 4)
@@ -1,27 +1,80 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QComboBox, QLineEdit, QPushButton, QLabel, QTableWidgetItem, QScrollArea
-from PyQt5.QtCore import Qt
-from order_book_copy import OrderBookWindow
-from tinkoff.invest import Client
+import argparse
+import time
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QComboBox, QLineEdit, QPushButton, QLabel, QTableWidgetItem, QScrollArea, QCompleter, QShortcut
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QStringListModel
+from PyQt5.QtGui import QKeySequence
+import asyncio
+from order_book_copy import OrderBookWindow, StreamManager
+from market_recorder import MarketRecorder
+from latency import TRACKER as LATENCY
+from profiler import PROFILER
+from connection_pool import ConnectionPool
 from portfolio_widget import PortfolioWidget
+from prices import NANO, format_nanos, step_decimals
+from instrument_cache import build_ticker_index, build_ticker_map, is_expired, load_cache, save_cache, select_instruments
 
-# Вспомогательная функция для загрузки инструментов
-def load_instruments_by_token(token):
-    class_codes = []
-    ticker_map = {}
-    with Client(token) as client:
-        all_instruments = []
-        shares = client.instruments.shares().instruments
-        all_instruments.extend(shares)
-        futures = client.instruments.futures().instruments
-        all_instruments.extend(futures)
-        codes = set()
-        for inst in all_instruments:
-            if inst.class_code in ("TQBR", "SPBFUT") and inst.api_trade_available_flag:
-                codes.add(inst.class_code)
-                ticker_map[(inst.ticker, inst.class_code)] = inst
-        class_codes = sorted(list(codes))
-    return class_codes, ticker_map
+class AuthWorker(QObject):
+    # Авторизация в фоне, на общей полосе пула подключений (connection_pool.py):
+    # по одному каналу акции, фьючерсы и счета запрашиваются параллельно.
+    # Каждая часть отдаётся своим сигналом, как только готова; полный справочник
+    # сохраняется в дисковый кэш и приходит сигналом instruments_loaded.
+    shares_loaded = pyqtSignal(object)      # list[InstrumentInfo]
+    futures_loaded = pyqtSignal(object)     # list[InstrumentInfo]
+    instruments_loaded = pyqtSignal(object)
+    accounts_loaded = pyqtSignal(object)
+    error = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, token, load_instruments=True):
+        super().__init__()
+        self.token = token
+        self.load_instruments = load_instruments
+        self._future = None
+
+    @property
+    def running(self):
+        return self._future is not None and not self._future.done()
+
+    def start(self):
+        self._future = ConnectionPool.lane(self.token).submit(self._run())
+
+    async def _run(self):
+        try:
+            await self._load()
+        except Exception as e:
+            self.error.emit(str(e))
+        finally:
+            self.finished.emit()
+
+    async def _load(self):
+        client = await ConnectionPool.lane(self.token).services()
+        jobs = [self._load_accounts(client)]
+        if self.load_instruments:
+            jobs.append(self._load_part(client.instruments.shares, self.shares_loaded))
+            jobs.append(self._load_part(client.instruments.futures, self.futures_loaded))
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.error.emit(str(result))
+        if self.load_instruments and not any(isinstance(result, Exception) for result in results[1:]):
+            instruments = results[1] + results[2]
+            try:
+                # Запись файла — в пуле потоков, чтобы не задерживать цикл общей полосы
+                await asyncio.get_running_loop().run_in_executor(None, save_cache, instruments)
+            except OSError as e:
+                self.error.emit(f"не удалось сохранить кэш инструментов: {e}")
+            self.instruments_loaded.emit(instruments)
+
+    async def _load_part(self, method, signal):
+        instruments = select_instruments((await method()).instruments)
+        signal.emit(instruments)
+        return instruments
+
+    async def _load_accounts(self, client):
+        accounts = (await client.users.get_accounts()).accounts
+        self.accounts_loaded.emit(accounts)
+        return accounts
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -31,6 +84,18 @@ class MainWindow(QMainWindow):
         self.class_codes = []
         self.ticker_map = {}
         self.order_books = []  # список всех стаканов
+        self.accounts = []
+        self.auth_worker = None
+        self._instrument_parts = {}  # справочник, пришедший частями: {'shares'/'futures': [...]}
+        self._instruments_saved_at = None  # время получения справочника с сервера (None — справочника нет)
+        # Отсортированные тикеры площадки — одна модель на площадку, общая для всех стаканов
+        self.ticker_models = {}  # class_code: QStringListModel
+        self._empty_ticker_model = QStringListModel(self)
+        self.profile_path = None  # куда сохранять профиль (None — в каталог данных)
+        # Профилировщик (profiler.py) включается и выключается из любого окна приложения
+        profiler_shortcut = QShortcut(QKeySequence("Ctrl+Shift+P"), self)
+        profiler_shortcut.setContext(Qt.ApplicationShortcut)
+        profiler_shortcut.activated.connect(self.toggle_profiler)
 
         self.setStyleSheet('''
             QMainWindow, QWidget { background: #181818; color: #C0C0C0; font-family: Consolas, monospace; font-size: 13px; }
@@ -67,28 +132,94 @@ class MainWindow(QMainWindow):
         self.content_layout.addStretch(1)
         main_layout.addLayout(self.content_layout)
 
+        self.load_cached_instruments()
+
+    def load_cached_instruments(self):
+        # Справочник из дискового кэша показывается сразу при запуске, ещё до авторизации
+        cached = load_cache()
+        if cached is None:
+            return
+        instruments, self._instruments_saved_at = cached
+        self.set_instruments(*build_ticker_map(instruments))
+
     def load_instruments(self):
         token = self.token_input.text().strip()
-        if not token:
+        if not token or (self.auth_worker is not None and self.auth_worker.running):
+            return
+        # Справочник уже показан из кэша (load_cached_instruments); с сервера он грузится,
+        # только если кэша нет или он устарел. Счета загружаются всегда.
+        saved_at = self._instruments_saved_at
+        load_instruments = saved_at is None or is_expired(saved_at)
+        # Без кэша списки заполняются по частям, по мере прихода акций и фьючерсов
+        self._instrument_parts = {} if saved_at is None else None
+        self.auth_button.setEnabled(False)
+        self.auth_button.setText("Загрузка...")
+        self.auth_worker = AuthWorker(token, load_instruments)
+        self.auth_worker.shares_loaded.connect(lambda instruments: self.on_instrument_part_loaded('shares', instruments))
+        self.auth_worker.futures_loaded.connect(lambda instruments: self.on_instrument_part_loaded('futures', instruments))
+        self.auth_worker.instruments_loaded.connect(self.on_instruments_loaded)
+        self.auth_worker.accounts_loaded.connect(self.on_accounts_loaded)
+        self.auth_worker.error.connect(lambda msg: print(f"[WARN] Авторизация: {msg}"))
+        self.auth_worker.finished.connect(self.on_auth_finished)
+        self.auth_worker.start()
+
+    def on_instrument_part_loaded(self, kind, instruments):
+        if self._instrument_parts is None:
+            return
+        self._instrument_parts[kind] = instruments
+        self.set_instruments(*build_ticker_map([inst for part in self._instrument_parts.values() for inst in part]))
+
+    def on_instruments_loaded(self, instruments):
+        self._instrument_parts = None
+        self._instruments_saved_at = time.time()
+        self.set_instruments(*build_ticker_map(instruments))
+
+    def on_accounts_loaded(self, accounts):
+        self.accounts = accounts
+
+    def on_auth_finished(self):
+        self.auth_button.setEnabled(True)
+        self.auth_button.setText("Авторизоваться")
+
+    def set_instruments(self, class_codes, ticker_map):
+        # Подменить справочник; списки в стаканах перезаполняются, только если он изменился
+        if class_codes == self.class_codes and ticker_map == self.ticker_map:
             return
-        class_codes, ticker_map = load_instruments_by_token(token)
         self.class_codes = class_codes
         self.ticker_map = ticker_map
-        # Получаем счета пользователя
-        try:
-            with Client(token) as client:
-                accounts = client.users.get_accounts().accounts
-                self.accounts = accounts
-        except Exception as e:
-            self.accounts = []
-        for ob in self.order_books:
-            ob['class_code_combo'].clear()
-            ob['class_code_combo'].addItems(self.class_codes)
-            ob['class_code_combo'].setEnabled(True)
-            ob['ticker_combo'].setEnabled(False)
-            ob['start_button'].setEnabled(False)
-            ob['class_code_combo'].setCurrentIndex(0)
-            self.on_class_code_changed(ob, 0)
+        # Тикеры стаканов запоминаются до обновления моделей: общая модель сбрасывает выбор
+        selected = [ob['ticker_combo'].currentText() for ob in self.order_books]
+        self.update_ticker_models(build_ticker_index(ticker_map.values()))
+        for ob, ticker in zip(self.order_books, selected):
+            self.fill_class_codes(ob, ticker)
+
+    def update_ticker_models(self, index):
+        # Модели площадок обновляются на месте, чтобы их не пришлось заново ставить в комбобоксы
+        for class_code, tickers in index.items():
+            model = self.ticker_models.get(class_code)
+            if model is None:
+                self.ticker_models[class_code] = QStringListModel(tickers, self)
+            elif model.stringList() != tickers:
+                model.setStringList(tickers)
+        for class_code in self.ticker_models.keys() - index.keys():
+            self.ticker_models[class_code].setStringList([])
+
+    def fill_class_codes(self, ob, ticker=None):
+        # Заполнить площадки стакана; выбор сохраняется, если площадка и тикер остались в справочнике
+        class_code = ob['class_code_combo'].currentText()
+        ob['class_code_combo'].blockSignals(True)
+        ob['class_code_combo'].clear()
+        ob['class_code_combo'].addItems(self.class_codes)
+        idx = max(0, ob['class_code_combo'].findText(class_code))
+        ob['class_code_combo'].setCurrentIndex(idx)
+        ob['class_code_combo'].blockSignals(False)
+        ob['class_code_combo'].setEnabled(True)
+        ob['ticker_combo'].setEnabled(False)
+        ob['start_button'].setEnabled(False)
+        self.on_class_code_changed(ob, idx)
+        ticker_idx = ob['ticker_combo'].findText(ticker) if ticker else -1
+        if ticker_idx >= 0:
+            ob['ticker_combo'].setCurrentIndex(ticker_idx)
 
     def add_order_book(self):
         # Панель управления для стакана
@@ -104,7 +235,14 @@ class MainWindow(QMainWindow):
         class_code_combo = QComboBox()
         class_code_combo.setPlaceholderText("Площадка")
         ticker_combo = QComboBox()
-        ticker_combo.setPlaceholderText("Тикер")
+        ticker_combo.setModel(self._empty_ticker_model)
+        # Поиск по мере ввода: подсказки по подстроке без учёта регистра
+        ticker_combo.setEditable(True)
+        ticker_combo.setInsertPolicy(QComboBox.NoInsert)
+        ticker_combo.lineEdit().setPlaceholderText("Тикер")
+        ticker_combo.completer().setCompletionMode(QCompleter.PopupCompletion)
+        ticker_combo.completer().setFilterMode(Qt.MatchContains)
+        ticker_combo.completer().setCaseSensitivity(Qt.CaseInsensitive)
         ticker_combo.setEnabled(False)
         start_button = QPushButton("Старт стрима")
         start_button.setEnabled(False)
@@ -138,17 +276,20 @@ class MainWindow(QMainWindow):
         class_code_combo.currentIndexChanged.connect(lambda idx, ob=ob_dict: self.on_class_code_changed(ob, idx))
         ticker_combo.currentIndexChanged.connect(lambda idx, ob=ob_dict: self.on_ticker_changed(ob, idx))
         start_button.clicked.connect(lambda checked, ob=ob_dict: self.toggle_stream(ob))
+        # Справочник уже загружен — новый стакан сразу получает площадки и тикеры
+        if self.class_codes:
+            self.fill_class_codes(ob_dict)
 
     def on_class_code_changed(self, ob, idx):
+        # Модели тикеров общие: clear() у комбобокса очистил бы их во всех стаканах
         if idx < 0 or not self.class_codes:
-            ob['ticker_combo'].clear()
+            ob['ticker_combo'].setModel(self._empty_ticker_model)
             ob['ticker_combo'].setEnabled(False)
             ob['start_button'].setEnabled(False)
             return
-        class_code = self.class_codes[idx]
-        ob['ticker_combo'].clear()
-        tickers = [t for (t, c) in self.ticker_map if c == class_code]
-        ob['ticker_combo'].addItems(sorted(tickers))
+        model = self.ticker_models.get(self.class_codes[idx], self._empty_ticker_model)
+        if ob['ticker_combo'].model() is not model:
+            ob['ticker_combo'].setModel(model)
         ob['ticker_combo'].setEnabled(True)
         self.on_ticker_changed(ob, ob['ticker_combo'].currentIndex())
 
@@ -168,23 +309,16 @@ class MainWindow(QMainWindow):
         if not instrument:
             return
         instrument_id = instrument.figi
-        lot_size = getattr(instrument, 'lot', 1)
-        # Получаем шаг цены
-        price_step = getattr(instrument, 'min_price_increment', None)
-        if price_step is None:
-            price_step = getattr(instrument, 'price_step', 0.01)
-        # min_price_increment может быть объектом типа Quotation (units, nano)
-        if hasattr(price_step, 'units') and hasattr(price_step, 'nano'):
-            price_step = float(price_step.units) + price_step.nano / 1e9
-        try:
-            price_step = float(price_step)
-        except Exception:
-            price_step = 0.01
-        print(f"[INFO] Для тикера {ticker} шаг цены: {price_step}")
+        lot_size = instrument.lot
+        # Шаг цены в нано (InstrumentInfo хранит min_price_increment уже в нано)
+        price_step = instrument.min_price_increment
+        if price_step <= 0:
+            price_step = NANO // 100
+        print(f"[INFO] Для тикера {ticker} шаг цены: {format_nanos(price_step, step_decimals(price_step), grouping=False)}")
         ob['order_book'].token = token
         ob['order_book'].figi = instrument_id
         ob['order_book'].lot_size = lot_size
-        ob['order_book'].price_step = price_step
+        ob['order_book'].price_step_nanos = price_step
         ob['order_book'].start_stream()
         ob['start_button'].setText("Стоп стрима")
         ob['start_button'].clicked.disconnect()
@@ -201,7 +335,7 @@ class MainWindow(QMainWindow):
 
     def show_portfolio(self):
         token = self.token_input.text().strip()
-        if not hasattr(self, 'accounts') or not self.accounts:
+        if not self.accounts:
             from PyQt5.QtWidgets import QMessageBox
             QMessageBox.warning(self, "Ошибка", "Нет доступных счетов для отображения портфеля!")
             return
@@ -210,8 +344,53 @@ class MainWindow(QMainWindow):
             self.portfolio_widget = PortfolioWidget(token, account_id)
         self.portfolio_widget.show()
 
+    def toggle_profiler(self):
+        if not PROFILER.running:
+            PROFILER.start()
+            print("[INFO] Профилировщик включён (Ctrl+Shift+P — остановить и сохранить)")
+            return
+        self.save_profile()
+
+    def save_profile(self):
+        if not PROFILER.running:
+            return
+        PROFILER.stop()
+        path = PROFILER.write(self.profile_path)
+        print(f"[INFO] Профиль сохранён: {path} {PROFILER.summary()}")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Tinkoff Trading Dashboard")
+    parser.add_argument('--record', nargs='?', const='', metavar='DIR',
+                        help="записывать стаканы и сделки стрима (по умолчанию в ~/.local/share/t-invest-dashboard/recordings)")
+    parser.add_argument('--latency', action='store_true',
+                        help="замерять задержки стаканов с запуска (оверлей — Ctrl+L, выгрузка — Ctrl+Shift+L)")
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                        help="сэмплировать главный поток и потоки стрима с запуска; профиль (collapsed stacks) "
+                             "сохраняется при выходе или по Ctrl+Shift+P")
+    parser.add_argument('--shard-size', type=int, metavar='N',
+                        help="сколько FIGI держать в одном стриме стаканов (0 — все в одном стриме)")
+    # Остальные аргументы остаются Qt
+    args, qt_args = parser.parse_known_args(argv[1:])
+    if args.shard_size is not None and args.shard_size < 0:
+        parser.error("--shard-size: ожидается число >= 0")
+    return args, qt_args
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    args, qt_args = parse_args(sys.argv)
+    app = QApplication(sys.argv[:1] + qt_args)
+    app.aboutToQuit.connect(ConnectionPool.close_all)
+    if args.record is not None:
+        StreamManager.recorder = MarketRecorder(args.record or None)
+        app.aboutToQuit.connect(StreamManager.recorder.close)
+        print(f"[INFO] Запись стрима: {StreamManager.recorder.directory}")
+    if args.latency:
+        LATENCY.acquire()
+    if args.shard_size is not None:
+        StreamManager.SHARD_SIZE = args.shard_size
     window = MainWindow()
+    if args.profile is not None:
+        window.profile_path = args.profile or None
+        PROFILER.start()
+    app.aboutToQuit.connect(window.save_profile)
     window.show()
     sys.exit(app.exec_())
\ No newline at end of file
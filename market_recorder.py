@@ -0,0 +1,213 @@
+# Запись рыночных данных стрима на диск для разбора инцидентов и воспроизведения.
+# Каждый FIGI пишется в свои сегменты: только дозапись, записи с префиксом длины.
+# Поток стрима лишь кодирует сообщение в bytes (struct + массивы снимка, без разбора объектов)
+# и кладёт его в очередь; файлы пишет отдельный поток пачками раз в FLUSH_INTERVAL.
+# Сегмент закрывается и начинается новый по размеру (SEGMENT_MAX_BYTES) или возрасту (SEGMENT_MAX_AGE).
+#
+# Формат сегмента <каталог>/<FIGI>/<время начала, нс>.seg (little-endian; массивы уровней
+# пишутся в родном порядке байт, на x86/ARM он тот же):
+#   заголовок: MAGIC (8 байт), шаг цены (i64, нано), лот (i64), длина FIGI (u16), FIGI (utf-8);
+#              шаг и лот 0 — не известны (FIGI не зарегистрирован через register)
+#   запись:    длина тела (u32), тело
+#   тело:      вид (u8), время получения (i64, нс от эпохи), затем
+#              KIND_ORDER_BOOK: число bid (u16), число ask (u16), цены bid, объёмы bid,
+#                               цены ask, объёмы ask (i64, цены в нано)
+#              KIND_TRADE:      цена (i64, нано), объём (i64), направление (i8)
+import os
+import struct
+import threading
+import time
+from collections import deque
+from paths import data_dir
+
+MAGIC = b"TIMDSEG2"
+SEGMENT_SUFFIX = ".seg"
+KIND_ORDER_BOOK = 1
+KIND_TRADE = 2
+
+SEGMENT_HEADER = struct.Struct("<8sqqH")  # MAGIC, шаг цены, лот, длина FIGI
+RECORD_LENGTH = struct.Struct("<I")
+RECORD_HEADER = struct.Struct("<Bq")  # вид и время — в начале каждого тела
+ORDER_BOOK_HEADER = struct.Struct("<IBqHH")  # длина, вид, время, bid, ask
+TRADE_RECORD = struct.Struct("<IBqqqb")  # длина, вид, время, цена, объём, направление
+ORDER_BOOK_COUNTS = struct.Struct("<HH")  # после RECORD_HEADER в теле стакана
+TRADE_BODY = struct.Struct("<qqb")  # после RECORD_HEADER в теле сделки
+TRADE_BODY_SIZE = TRADE_RECORD.size - RECORD_LENGTH.size
+
+def default_directory():
+    return data_dir('recordings')
+
+def encode_order_book(timestamp_ns, snapshot):
+    # BookSnapshot -> запись; массивы цен и объёмов копируются целиком, без цикла по уровням
+    bids = snapshot.bid_count
+    asks = snapshot.ask_count
+    size = RECORD_HEADER.size + ORDER_BOOK_COUNTS.size + 16 * (bids + asks)
+    return b"".join((
+        ORDER_BOOK_HEADER.pack(size, KIND_ORDER_BOOK, timestamp_ns, bids, asks),
+        snapshot.bid_prices[:bids].tobytes(),
+        snapshot.bid_quantities[:bids].tobytes(),
+        snapshot.ask_prices[:asks].tobytes(),
+        snapshot.ask_quantities[:asks].tobytes(),
+    ))
+
+def encode_trade(timestamp_ns, price, quantity, direction):
+    return TRADE_RECORD.pack(TRADE_BODY_SIZE, KIND_TRADE, timestamp_ns, price, quantity, direction)
+
+class _Segment:
+    # Открытый сегмент одного FIGI; используется только потоком записи
+    __slots__ = ('file', 'path', 'size', 'header_size', 'opened_at', 'instrument')
+
+    def __init__(self, directory, figi, timestamp_ns, instrument):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{timestamp_ns:020d}{SEGMENT_SUFFIX}")
+        self.file = open(self.path, 'xb')
+        self.instrument = instrument
+        name = figi.encode('utf-8')
+        step, lot = instrument
+        self.file.write(SEGMENT_HEADER.pack(MAGIC, step, lot, len(name)) + name)
+        self.size = self.header_size = SEGMENT_HEADER.size + len(name)
+        self.opened_at = time.monotonic()
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+class MarketRecorder:
+    # Регистратор стрима. record_* вызываются из потоков шардов и не блокируются:
+    # запись — это deque.append готовых bytes. Если поток записи не успевает и очередь
+    # переполнена, новые сообщения отбрасываются (счётчик dropped), а не тормозят стрим.
+    FLUSH_INTERVAL = 0.2  # секунды
+    SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+    SEGMENT_MAX_AGE = 60 * 60  # секунды
+    MAX_PENDING = 200_000  # записей в очереди
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory()
+        self.records = 0
+        self.bytes_written = 0
+        self.segments = 0
+        self.dropped = 0
+        self.last_error = None
+        self._pending = deque()
+        self._segments = {}  # figi: _Segment
+        self._instruments = {}  # figi: (шаг цены в нано, лот) для заголовков сегментов
+        self._stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="market-recorder", daemon=True)
+        self.thread.start()
+
+    def register(self, figi, price_step_nanos, lot_size):
+        # Шаг цены и лот FIGI попадают в заголовок его сегментов: воспроизведение строит
+        # лестницу с тем же шагом. Если они поменялись, следующая запись начнёт новый сегмент.
+        self._instruments[figi] = (int(price_step_nanos or 0), int(lot_size or 0))
+
+    def record_order_book(self, figi, snapshot, timestamp_ns=None):
+        if len(self._pending) >= self.MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append((figi, encode_order_book(timestamp_ns or time.time_ns(), snapshot)))
+
+    def record_trade(self, figi, price, quantity, direction, timestamp_ns=None):
+        if len(self._pending) >= self.MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append((figi, encode_trade(timestamp_ns or time.time_ns(), price, quantity, direction)))
+
+    def close(self, timeout=5):
+        # Дописать очередь и закрыть сегменты
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'records': self.records,
+            'bytes_written': self.bytes_written,
+            'segments': self.segments,
+            'open_segments': len(self._segments),
+            'pending': len(self._pending),
+            'dropped': self.dropped,
+            'last_error': self.last_error,
+        }
+
+    def _run(self):
+        try:
+            while not self._stopping.wait(self.FLUSH_INTERVAL):
+                self._flush()
+            self._flush()
+        finally:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+    def _flush(self):
+        # Забрать всё накопленное, сгруппировать по FIGI и записать одним write на сегмент
+        pending = self._pending
+        batches = {}
+        try:
+            while True:
+                figi, data = pending.popleft()
+                batches.setdefault(figi, []).append(data)
+        except IndexError:
+            pass
+        for figi, chunks in batches.items():
+            try:
+                self._write(figi, chunks)
+                self.records += len(chunks)
+            except OSError as e:
+                self.last_error = str(e)
+        now = time.monotonic()
+        for figi, segment in list(self._segments.items()):
+            if now - segment.opened_at >= self.SEGMENT_MAX_AGE:
+                self._rotate(figi)
+            else:
+                segment.file.flush()
+
+    def _write(self, figi, chunks):
+        # Пачка пишется одним write на сегмент; записи не разрываются между сегментами
+        segment = self._segments.get(figi)
+        if segment is not None and segment.instrument != self._instruments.get(figi, (0, 0)):
+            self._rotate(figi)
+            segment = None
+        segment = segment or self._open(figi)
+        start = 0
+        size = segment.size
+        for i, chunk in enumerate(chunks):
+            if size + len(chunk) > self.SEGMENT_MAX_BYTES and size > segment.header_size:
+                # Сегмент заполнен: дописать накопленное и продолжить в новом
+                self._append(segment, chunks[start:i])
+                self._rotate(figi)
+                segment = self._open(figi)
+                start = i
+                size = segment.size
+            size += len(chunk)
+        self._append(segment, chunks[start:])
+
+    def _append(self, segment, chunks):
+        data = b"".join(chunks)
+        if data:
+            segment.write(data)
+            self.bytes_written += len(data)
+
+    def _open(self, figi):
+        timestamp_ns = time.time_ns()
+        directory = os.path.join(self.directory, figi)
+        while True:
+            try:
+                segment = _Segment(directory, figi, timestamp_ns, self._instruments.get(figi, (0, 0)))
+                break
+            except FileExistsError:
+                timestamp_ns += 1
+        self._segments[figi] = segment
+        self.segments += 1
+        return segment
+
+    def _rotate(self, figi):
+        segment = self._segments.pop(figi, None)
+        if segment is not None:
+            segment.close()
@@ -0,0 +1,425 @@
+# Воспроизведение записей стрима (market_recorder.py) в OrderBookWindow без токена и сети.
+# Сегменты открываются через mmap и читаются на месте; для перемотки у каждого сегмента
+# есть разреженный индекс (время, смещение) каждой INDEX_STRIDE-й записи.
+# Кадры строятся в потоке воспроизведения тем же LadderBuilder'ом, что и в шарде стрима,
+# и уходят в окно через тот же data_from_stream — путь отрисовки не отличается от живого.
+#
+#   python market_replay.py ~/.local/share/t-invest-dashboard/recordings --speed 10
+#   QT_QPA_PLATFORM=offscreen python market_replay.py ./recordings --speed max --exit   # нагрузка на CI
+import argparse
+import bisect
+import heapq
+import mmap
+import os
+import sys
+import threading
+import time
+from array import array
+from PyQt5.QtCore import QObject, pyqtSignal
+from instrument_cache import load_cache
+from market_recorder import (KIND_ORDER_BOOK, KIND_TRADE, MAGIC, ORDER_BOOK_COUNTS, RECORD_HEADER, RECORD_LENGTH,
+                             SEGMENT_HEADER, SEGMENT_SUFFIX, TRADE_BODY)
+from order_book_copy import LadderBuilder, TradeTick
+from profiler import label
+
+class SegmentReader:
+    # Один сегмент, отображённый в память. Индекс строится одним проходом по длинам записей;
+    # недописанная запись в хвосте (сегмент ещё пишется) не читается.
+    # Шаг цены и лот — из заголовка; 0 — не известны (FIGI писался без register).
+    INDEX_STRIDE = 256
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < SEGMENT_HEADER.size:
+                raise ValueError(f"{path}: пустой сегмент")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.price_step_nanos, self.lot_size, name_size = SEGMENT_HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            self.data.close()
+            raise ValueError(f"{path}: не сегмент записи стрима")
+        self.figi = self.data[SEGMENT_HEADER.size:SEGMENT_HEADER.size + name_size].decode('utf-8')
+        self.start = SEGMENT_HEADER.size + name_size
+        self._build_index()
+
+    def _build_index(self):
+        data = self.data
+        size = len(data)
+        offset = self.start
+        last = None
+        count = 0
+        self.index_times = array('q')
+        self.index_offsets = array('q')
+        while offset + RECORD_LENGTH.size + RECORD_HEADER.size <= size:
+            (length,) = RECORD_LENGTH.unpack_from(data, offset)
+            if offset + RECORD_LENGTH.size + length > size:
+                break
+            if count % self.INDEX_STRIDE == 0:
+                self.index_times.append(self.timestamp_at(offset))
+                self.index_offsets.append(offset)
+            last = offset
+            offset += RECORD_LENGTH.size + length
+            count += 1
+        self.end = offset
+        self.records = count
+        self.first_time = self.index_times[0] if count else None
+        self.last_time = self.timestamp_at(last) if count else None
+
+    def timestamp_at(self, offset):
+        return RECORD_HEADER.unpack_from(self.data, offset + RECORD_LENGTH.size)[1]
+
+    def next_offset(self, offset):
+        return offset + RECORD_LENGTH.size + RECORD_LENGTH.unpack_from(self.data, offset)[0]
+
+    def seek(self, timestamp_ns):
+        # Смещение первой записи не раньше timestamp_ns: по индексу до ближайшей опорной
+        # записи, дальше не больше INDEX_STRIDE записей линейно
+        i = bisect.bisect_right(self.index_times, timestamp_ns) - 1
+        offset = self.index_offsets[i] if i >= 0 else self.start
+        while offset < self.end and self.timestamp_at(offset) < timestamp_ns:
+            offset = self.next_offset(offset)
+        return offset
+
+    def close(self):
+        self.data.close()
+
+class ReplayTrack:
+    # Записи одного FIGI: сегменты по порядку и текущая позиция (сегмент, смещение)
+    def __init__(self, figi, segments):
+        self.figi = figi
+        self.segments = segments
+        self.window = None
+        self.builder = None
+        self.rewind()
+
+    @property
+    def first_time(self):
+        return self.segments[0].first_time if self.segments else None
+
+    @property
+    def last_time(self):
+        return self.segments[-1].last_time if self.segments else None
+
+    @property
+    def price_step_nanos(self):
+        # Из заголовка последнего сегмента, где он записан; 0 — шаг не записан ни в одном
+        return next((segment.price_step_nanos for segment in reversed(self.segments) if segment.price_step_nanos), 0)
+
+    @property
+    def lot_size(self):
+        return next((segment.lot_size for segment in reversed(self.segments) if segment.lot_size), 0)
+
+    def rewind(self):
+        self._segment = 0
+        self._offset = self.segments[0].start if self.segments else 0
+        self._skip_finished()
+
+    def seek(self, timestamp_ns):
+        for i, segment in enumerate(self.segments):
+            if segment.last_time is not None and segment.last_time >= timestamp_ns:
+                self._segment = i
+                self._offset = segment.seek(timestamp_ns)
+                return
+        self._segment = len(self.segments)
+
+    def head_time(self):
+        # Время текущей записи; None — записи кончились
+        if self._segment >= len(self.segments):
+            return None
+        return self.segments[self._segment].timestamp_at(self._offset)
+
+    def advance(self):
+        segment = self.segments[self._segment]
+        self._offset = segment.next_offset(self._offset)
+        self._skip_finished()
+
+    def _skip_finished(self):
+        while self._segment < len(self.segments) and self._offset >= self.segments[self._segment].end:
+            self._segment += 1
+            if self._segment < len(self.segments):
+                self._offset = self.segments[self._segment].start
+
+    @label('stream_decode')
+    def read(self):
+        # Текущая запись -> LadderFrame, TradeTick или None (пустой стакан, неизвестный вид)
+        segment = self.segments[self._segment]
+        data = segment.data
+        body = self._offset + RECORD_LENGTH.size
+        kind, _ = RECORD_HEADER.unpack_from(data, body)
+        if kind == KIND_ORDER_BOOK:
+            snapshot = self.builder.snapshot
+            offset = body + RECORD_HEADER.size
+            bids, asks = ORDER_BOOK_COUNTS.unpack_from(data, offset)
+            offset += ORDER_BOOK_COUNTS.size
+            for prices, quantities, count in ((snapshot.bid_prices, snapshot.bid_quantities, bids),
+                                              (snapshot.ask_prices, snapshot.ask_quantities, asks)):
+                prices[:count] = array('q', data[offset:offset + 8 * count])
+                offset += 8 * count
+                quantities[:count] = array('q', data[offset:offset + 8 * count])
+                offset += 8 * count
+            snapshot.bid_count = bids
+            snapshot.ask_count = asks
+            return self.builder.build(snapshot)
+        if kind == KIND_TRADE:
+            price, quantity, direction = TRADE_BODY.unpack_from(data, body + RECORD_HEADER.size)
+            return TradeTick(price, quantity, direction)
+        return None
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+def open_tracks(directory, figis=None):
+    # {FIGI: ReplayTrack} по каталогу записи (<каталог>/<FIGI>/*.seg)
+    tracks = {}
+    for figi in sorted(os.listdir(directory)):
+        if figis and figi not in figis:
+            continue
+        figi_dir = os.path.join(directory, figi)
+        if not os.path.isdir(figi_dir):
+            continue
+        segments = []
+        for name in sorted(os.listdir(figi_dir)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                segment = SegmentReader(os.path.join(figi_dir, name))
+            except (OSError, ValueError):
+                continue
+            if segment.records:
+                segments.append(segment)
+            else:
+                segment.close()
+        if segments:
+            tracks[figi] = ReplayTrack(figi, segments)
+    return tracks
+
+class MarketReplay(QObject):
+    # Источник данных для OrderBookWindow из записи: attach(figi, окно), start(), дальше
+    # pause/resume, set_speed и seek из GUI-потока. speed — множитель реального времени,
+    # 0 — максимально быстро. Чтобы не переполнить очередь событий Qt, в полёте (отправлено,
+    # но ещё не принято окнами) держится не больше MAX_IN_FLIGHT сообщений.
+    finished = pyqtSignal()
+    MAX_IN_FLIGHT = 2048
+
+    def __init__(self, directory, figis=None, speed=1.0):
+        super().__init__()
+        self.directory = directory
+        self.tracks = open_tracks(directory, figis)
+        self.speed = speed
+        self.running = False
+        self.paused = False
+        self.position = None  # время последнего отправленного сообщения, нс
+        self.emitted = 0
+        self.delivered = 0
+        self.thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._seek_to = None
+        self._anchor = None  # (monotonic, время записи), от которого отсчитывается темп
+
+    def attach(self, figi, window):
+        # Окно получает записи FIGI; шаг цены и лот берутся из окна, как в StreamManager.register
+        track = self.tracks[figi]
+        track.window = window
+        track.builder = LadderBuilder(window.price_step_nanos, window.lot_size)
+        window.data_from_stream.connect(self._on_delivered)
+
+    def detach(self, figi):
+        track = self.tracks.get(figi)
+        if track is not None and track.window is not None:
+            track.window.data_from_stream.disconnect(self._on_delivered)
+            track.window = None
+
+    def time_range(self):
+        times = [(t.first_time, t.last_time) for t in self.tracks.values()]
+        if not times:
+            return None
+        return min(first for first, _ in times), max(last for _, last in times)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="market-replay", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=2):
+        self.running = False
+        self._wake.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        self.thread = None
+
+    def close(self):
+        self.stop()
+        for figi in list(self.tracks):
+            self.detach(figi)
+        for track in self.tracks.values():
+            track.close()
+
+    def pause(self):
+        self.paused = True
+        self._wake.set()
+
+    def resume(self):
+        with self._lock:
+            self.paused = False
+            self._anchor = None
+        self._wake.set()
+
+    def set_speed(self, speed):
+        with self._lock:
+            self.speed = max(0.0, float(speed))
+            self._anchor = None
+        self._wake.set()
+
+    def seek(self, timestamp_ns):
+        with self._lock:
+            self._seek_to = timestamp_ns
+        self._wake.set()
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'paused': self.paused,
+            'speed': self.speed,
+            'position': self.position,
+            'emitted': self.emitted,
+            'delivered': self.delivered,
+            'in_flight': self.emitted - self.delivered,
+        }
+
+    def _on_delivered(self, data):
+        # GUI-поток: окно приняло сообщение из очереди событий
+        self.delivered += 1
+
+    def _run(self):
+        heap = None
+        while self.running:
+            with self._lock:
+                seek_to, self._seek_to = self._seek_to, None
+                if seek_to is not None:
+                    self._anchor = None
+            if heap is None or seek_to is not None:
+                heap = self._reset(seek_to)
+            if self.paused:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            if not heap:
+                break
+            timestamp, figi = heap[0]
+            if self._wait(timestamp):
+                continue  # изменилось управление — пересчитать с начала
+            track = self.tracks[figi]
+            message = track.read()
+            if message is not None and track.window is not None:
+                self.emitted += 1
+                track.window.data_from_stream.emit(message)
+            self.position = timestamp
+            track.advance()
+            head = track.head_time()
+            if head is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (head, figi))
+        if self.running:
+            self.running = False
+            self.finished.emit()
+
+    def _reset(self, seek_to):
+        heap = []
+        for figi, track in self.tracks.items():
+            if track.window is None:
+                continue
+            if seek_to is None:
+                track.rewind()
+            else:
+                track.seek(seek_to)
+            head = track.head_time()
+            if head is not None:
+                heap.append((head, figi))
+        heapq.heapify(heap)
+        return heap
+
+    def _wait(self, timestamp):
+        # Дождаться времени записи (с учётом скорости) и места в очереди окон.
+        # True — ожидание прервано управлением (пауза, скорость, перемотка, остановка).
+        while self.emitted - self.delivered >= self.MAX_IN_FLIGHT:
+            if self._wake.wait(0.001):
+                self._wake.clear()
+                return True
+        with self._lock:
+            speed = self.speed
+            if speed <= 0:
+                return False
+            if self._anchor is None:
+                self._anchor = (time.monotonic(), timestamp)
+            anchor_time, anchor_timestamp = self._anchor
+        delay = anchor_time + (timestamp - anchor_timestamp) / 1e9 / speed - time.monotonic()
+        if delay > 0 and self._wake.wait(delay):
+            self._wake.clear()
+            return True
+        return False
+
+def instrument_steps(tracks):
+    # {FIGI: (шаг цены в нано, лот)} из заголовков сегментов; FIGI без шага в записи
+    # (писались без register) берутся из кэша справочника инструментов, если он есть
+    steps = {figi: (track.price_step_nanos, track.lot_size or 1)
+             for figi, track in tracks.items() if track.price_step_nanos}
+    if len(steps) < len(tracks):
+        cached = load_cache()
+        for inst in cached[0] if cached else ():
+            if inst.figi in tracks and inst.figi not in steps and inst.min_price_increment:
+                steps[inst.figi] = (inst.min_price_increment, inst.lot or 1)
+    return steps
+
+def parse_speed(value):
+    return 0.0 if value == 'max' else float(value)
+
+def main(argv):
+    from PyQt5.QtWidgets import QApplication
+    from order_book_copy import OrderBookWindow
+    parser = argparse.ArgumentParser(description="Воспроизведение записи стрима в стаканах")
+    parser.add_argument('directory', help="каталог записи (main.py --record)")
+    parser.add_argument('--figi', action='append', help="FIGI для воспроизведения (по умолчанию все)")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="множитель скорости или max")
+    parser.add_argument('--seek', type=float, default=0.0, help="начать с этой секунды записи")
+    parser.add_argument('--exit', action='store_true', help="закрыться по окончании записи")
+    args, qt_args = parser.parse_known_args(argv[1:])
+    app = QApplication(argv[:1] + qt_args)
+    replay = MarketReplay(args.directory, args.figi, args.speed)
+    if not replay.tracks:
+        print(f"[ERROR] В {args.directory} нет записей")
+        return 1
+    instruments = instrument_steps(replay.tracks)
+    missing = sorted(figi for figi in replay.tracks if figi not in instruments)
+    if missing:
+        print(f"[ERROR] Нет шага цены в записи и в кэше инструментов: {', '.join(missing)}")
+        return 1
+    windows = []
+    for figi, track in replay.tracks.items():
+        window = OrderBookWindow()
+        window.figi = figi
+        window.price_step_nanos, window.lot_size = instruments[figi]
+        window.setWindowTitle(f"{figi} — воспроизведение")
+        window.show()
+        replay.attach(figi, window)
+        windows.append(window)
+    first, last = replay.time_range()
+    print(f"[INFO] Воспроизведение {len(windows)} FIGI, {(last - first) / 1e9:.1f} с записи")
+    if args.seek:
+        replay.seek(first + int(args.seek * 1e9))
+    started = time.monotonic()
+    if args.exit:
+        replay.finished.connect(app.quit)
+    app.aboutToQuit.connect(replay.close)
+    replay.start()
+    code = app.exec_()
+    print(f"[INFO] {replay.stats()} за {time.monotonic() - started:.2f} с, "
+          f"потеряно событий: {sum(w.dropped_events for w in windows)}")
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
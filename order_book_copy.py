@@ -1,16 +1,35 @@
 import sys
 from PyQt5.QtWidgets import (QApplication, QWidget, QTableWidget, QTableWidgetItem,
-                            QVBoxLayout, QLabel, QHeaderView, QShortcut, QLineEdit, QPushButton, QHBoxLayout, QAbstractItemView, QStyledItemDelegate)
-from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer, pyqtSlot
+                            QVBoxLayout, QLabel, QHeaderView, QShortcut, QLineEdit, QPushButton, QHBoxLayout, QAbstractItemView, QStyledItemDelegate, QTableView)
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer, pyqtSlot, QAbstractTableModel, QModelIndex
 from PyQt5.QtGui import QColor, QKeySequence, QFont, QBrush, QPainter
 import threading
+import math
+import weakref
+import time
+from array import array
 from tinkoff.invest import AsyncClient, MarketDataRequest, SubscribeOrderBookRequest, SubscribeTradesRequest, SubscriptionAction, OrderBookInstrument, TradeInstrument, TradeDirection
 import asyncio
-from enum import Enum
+from collections import deque
+from prices import NANO, format_nanos, price_decimals
+from connection_pool import ConnectionPool, reconnect_delay
+from latency import TRACKER as LATENCY, LatencyOverlay, LatencyStamps
+from profiler import label
+try:
+    from tinkoff.invest import PingDelaySettings
+except ImportError:  # старые версии tinkoff-investments
+    PingDelaySettings = None
 
-class TradeDirection(Enum):
-    TRADE_DIRECTION_BUY = 1
-    TRADE_DIRECTION_SELL = 2
+# Сервер сам присылает ping в стрим с этим интервалом — пустые запросы от клиента не нужны
+STREAM_PING_DELAY_MS = 30000
+# Столько тишины (ни данных, ни пингов) считаем обрывом соединения
+STREAM_IDLE_TIMEOUT = 3 * (STREAM_PING_DELAY_MS if PingDelaySettings is not None else 180000) / 1000
+
+def ping_settings_request():
+    # Настройка интервала серверных пингов; None, если версия API её не поддерживает
+    if PingDelaySettings is None:
+        return None
+    return MarketDataRequest(ping_settings=PingDelaySettings(ping_delay_ms=STREAM_PING_DELAY_MS))
 
 class OrderBookStreamer(QObject):
     data_updated = pyqtSignal(dict)
@@ -22,22 +41,45 @@ class OrderBookStreamer(QObject):
         self.figi = figi
         self.running = False
         self.thread = None
+        self._loop = None
+        self._task = None
+        self._stopped = None
 
     def start(self):
         self.running = True
+        self._loop = asyncio.new_event_loop()
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
 
     def stop(self):
         self.running = False
+        try:
+            self._loop.call_soon_threadsafe(self._shutdown)
+        except (AttributeError, RuntimeError):
+            pass  # стрим не запускался или уже завершился
+
+    def _shutdown(self):
+        if self._stopped is not None:
+            self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
 
     def _run(self):
-        asyncio.run(self._async_stream())
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._async_stream())
+        finally:
+            self._loop.close()
 
     async def _async_stream(self):
+        self._task = asyncio.current_task()
+        self._stopped = asyncio.Event()
         try:
             async with AsyncClient(self.token) as client:
                 async def request_iterator():
+                    ping_settings = ping_settings_request()
+                    if ping_settings is not None:
+                        yield ping_settings
                     yield MarketDataRequest(
                         subscribe_order_book_request=SubscribeOrderBookRequest(
                             subscription_action=SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE,
@@ -50,9 +92,8 @@ class OrderBookStreamer(QObject):
                             instruments=[TradeInstrument(instrument_id=self.figi)]
                         )
                     )
-                    while self.running:
-                        await asyncio.sleep(0.1)
-                        yield MarketDataRequest()
+                    # Новых запросов не будет: поток запросов открыт до остановки
+                    await self._stopped.wait()
                 stream = client.market_data_stream.market_data_stream(request_iterator())
                 async for response in stream:
                     if not self.running:
@@ -60,73 +101,637 @@ class OrderBookStreamer(QObject):
                     data = {}
                     if hasattr(response, 'orderbook') and response.orderbook is not None:
                         order_book = response.orderbook
-                        asks = [(float(a.price.units) + a.price.nano / 1e9, a.quantity, 0) for a in order_book.asks]
-                        bids = [(float(b.price.units) + b.price.nano / 1e9, b.quantity, 0) for b in order_book.bids]
+                        asks = [(a.price.units * NANO + a.price.nano, a.quantity, 0) for a in order_book.asks]
+                        bids = [(b.price.units * NANO + b.price.nano, b.quantity, 0) for b in order_book.bids]
                         data['bids'] = bids
                         data['asks'] = asks
                     if hasattr(response, 'trade') and response.trade is not None:
                         trade = response.trade
                         if trade.price is not None:
                             trade_data = {
-                                'price': float(trade.price.units) + trade.price.nano / 1e9,
+                                'price': trade.price.units * NANO + trade.price.nano,
                                 'quantity': trade.quantity,
                                 'direction': trade.direction
                             }
                             data['trade'] = trade_data
                     if data:
                         self.data_updated.emit(data)
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
             self.error.emit(str(e))
 
 class VolumeBarDelegate(QStyledItemDelegate):
-    def __init__(self, min_vol, max_vol, row_colors, is_sum_mode=False, parent=None):
+    # Один делегат на стакан: значения и масштаб полос читаются прямо из массивов модели,
+    # кисти создаются один раз (прозрачность 0.9 запечена в цвет, без save/restore на строку)
+    MIN_BAR_WIDTH = 4
+
+    def __init__(self, model, parent=None):
         super().__init__(parent)
-        self.min_vol = min_vol
-        self.max_vol = max_vol
-        self.row_colors = row_colors
-        self.is_sum_mode = is_sum_mode
+        self.model = model
+        self._brushes = tuple(QBrush(QColor(c.red(), c.green(), c.blue(), 230)) for c in OrderBookModel.BAR_COLORS)
 
+    @label('bar_paint')
     def paint(self, painter, option, index):
-        if self.is_sum_mode and index.column() == 0:
-            try:
-                value = float(index.data(Qt.UserRole))
-            except (TypeError, ValueError):
-                value = 0
+        model = self.model
+        row = index.row()
+        if model.ladder is not None and row < model.rowCount():
+            value = model.bar_value(row)
+            if value > 0:
+                min_value, max_value = model.bar_range()
+                ratio = (value - min_value) / (max_value - min_value) if max_value > min_value else 0
+                rect = option.rect
+                bar_width = max(int(rect.width() * ratio), self.MIN_BAR_WIDTH)
+                painter.fillRect(rect.x(), rect.y(), bar_width, rect.height(), self._brushes[model.bar_kind(row)])
+        super().paint(painter, option, index)
+
+class PriceLadder:
+    # Лестница цен: номер тика (цена / шаг цены) <-> строка таблицы за O(1).
+    # Цены и шаг — целые нано (см. prices.py), поэтому вся арифметика точная.
+    # Строки идут сверху вниз от top_tick к bottom_tick, строка-спред (если есть)
+    # вставлена на позицию spread_row.
+    __slots__ = ('step', 'top_tick', 'bottom_tick', 'spread_row')
+
+    def __init__(self, step, top_tick, bottom_tick, spread_row=-1):
+        self.step = step
+        self.top_tick = top_tick
+        self.bottom_tick = bottom_tick
+        self.spread_row = spread_row
+
+    @staticmethod
+    def spread_row_for(top_tick, best_bid, best_ask):
+        # Строка-спред нужна, только если между лучшими bid и ask есть свободные тики
+        if best_bid is None or best_ask is None or best_ask - best_bid < 2:
+            return -1
+        return top_tick - best_ask + 1
+
+    def __len__(self):
+        return self.top_tick - self.bottom_tick + 1 + (1 if self.spread_row >= 0 else 0)
+
+    def tick_of(self, price):
+        return (price + self.step // 2) // self.step
+
+    def row_of_tick(self, tick):
+        if tick is None or tick > self.top_tick or tick < self.bottom_tick:
+            return -1
+        offset = self.top_tick - tick
+        if self.spread_row >= 0 and offset >= self.spread_row:
+            offset += 1
+        return offset
+
+    def row_of_price(self, price):
+        if price is None:
+            return -1
+        return self.row_of_tick(self.tick_of(price))
+
+    def tick_of_row(self, row):
+        # None — строка-спред
+        if row == self.spread_row:
+            return None
+        if self.spread_row >= 0 and row > self.spread_row:
+            row -= 1
+        return self.top_tick - row
+
+    def prices(self):
+        return [None if tick is None else tick * self.step
+                for tick in (self.tick_of_row(row) for row in range(len(self)))]
+
+class BookSnapshot:
+    # Снимок стакана в предвыделенных массивах: цены (нано) и объёмы уровней по сторонам.
+    # Один экземпляр на стакан; поток стрима перезаполняет его на месте для каждого
+    # сообщения, без списков кортежей на каждый уровень. Массивы растут, только если
+    # пришло больше уровней, чем было выделено.
+    __slots__ = ('bid_prices', 'bid_quantities', 'bid_count', 'ask_prices', 'ask_quantities', 'ask_count')
+
+    def __init__(self, depth=50):
+        self.bid_prices = array('q', bytes(8 * depth))
+        self.bid_quantities = array('q', bytes(8 * depth))
+        self.bid_count = 0
+        self.ask_prices = array('q', bytes(8 * depth))
+        self.ask_quantities = array('q', bytes(8 * depth))
+        self.ask_count = 0
+
+    def fill(self, order_book):
+        # Из OrderBook стрима (уровни с price: Quotation и quantity)
+        self.bid_count = self._fill_side(order_book.bids, self.bid_prices, self.bid_quantities)
+        self.ask_count = self._fill_side(order_book.asks, self.ask_prices, self.ask_quantities)
+        return self
+
+    def set_levels(self, bids, asks):
+        # Из списков (цена в нано, объём, _) — для снимков, переданных напрямую
+        self.bid_count = self._set_side(bids, self.bid_prices, self.bid_quantities)
+        self.ask_count = self._set_side(asks, self.ask_prices, self.ask_quantities)
+        return self
+
+    @staticmethod
+    def _reserve(prices, quantities, count):
+        if count > len(prices):
+            extra = bytes(8 * (count - len(prices)))
+            prices.frombytes(extra)
+            quantities.frombytes(extra)
+
+    @classmethod
+    def _fill_side(cls, orders, prices, quantities):
+        cls._reserve(prices, quantities, len(orders))
+        for i, order in enumerate(orders):
+            price = order.price
+            prices[i] = price.units * NANO + price.nano
+            quantities[i] = order.quantity
+        return len(orders)
+
+    @classmethod
+    def _set_side(cls, levels, prices, quantities):
+        cls._reserve(prices, quantities, len(levels))
+        for i, (price, quantity, _) in enumerate(levels):
+            prices[i] = price
+            quantities[i] = quantity
+        return len(levels)
+
+class TradeTick:
+    # Сделка из стрима: цена в нано, объём в лотах, направление — int (TradeDirection);
+    # count — сколько сделок объединено при агрегации
+    __slots__ = ('price', 'quantity', 'direction', 'count', 'stamps')
+
+    def __init__(self, price, quantity, direction, count=1, stamps=None):
+        self.price = price
+        self.quantity = quantity
+        self.direction = direction
+        self.count = count
+        self.stamps = stamps  # LatencyStamps, если включён замер задержек (latency.py)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['price'], data['quantity'], int(data['direction']), data.get('count', 1))
+
+    def as_dict(self):
+        return {'price': self.price, 'quantity': self.quantity, 'direction': self.direction, 'count': self.count}
+
+class LadderFrame:
+    # Готовый кадр лестницы одного стакана: объёмы, суммы и зоны по строкам, лучшие цены
+    # и максимумы. Строится LadderBuilder'ом в потоке стрима и после этого не меняется —
+    # GUI-поток только подставляет его в модель.
+    # changed_rows — строки, отличающиеся от предыдущего кадра того же построителя
+    # (None — лестница перестроена целиком).
+    ZONE_EMPTY = 0
+    ZONE_ASK = 1
+    ZONE_BID = 2
+    ZONE_SPREAD = 3
+    __slots__ = ('source', 'seq', 'ladder', 'structure', 'volumes', 'sums', 'zones',
+                 'markers', 'marker_rows', 'volume_range', 'sum_range', 'changed_rows', 'stamps')
+
+    def __init__(self, source, seq, ladder, volumes, sums, zones, markers,
+                 volume_range, sum_range, changed_rows):
+        self.source = source
+        self.seq = seq
+        self.ladder = ladder
+        self.structure = (ladder.step, ladder.bottom_tick, ladder.top_tick, ladder.spread_row)
+        self.volumes = volumes
+        self.sums = sums      # суммы в сотых долях валюты (копейках)
+        self.zones = zones
+        self.markers = markers  # тики: лучший ask, лучший bid, максимум ask, максимум bid
+        self.marker_rows = tuple(ladder.row_of_tick(t) for t in markers)
+        self.volume_range = volume_range  # (минимум > 0, максимум)
+        self.sum_range = sum_range
+        self.changed_rows = changed_rows
+        self.stamps = None  # LatencyStamps, ставит поток стрима до отправки кадра (latency.py)
+
+    def __len__(self):
+        return len(self.zones)
+
+    @property
+    def max_sum(self):
+        return self.sum_range[1]
+
+    def levels(self):
+        # -> (bids, asks): уровни (цена в нано, объём, 0), лучшие первыми
+        ladder = self.ladder
+        volumes = self.volumes
+        zones = self.zones
+        bids = []
+        asks = []
+        for row, zone in enumerate(zones):
+            if zone == self.ZONE_BID:
+                bids.append((ladder.tick_of_row(row) * ladder.step, volumes[row], 0))
+            elif zone == self.ZONE_ASK:
+                asks.append((ladder.tick_of_row(row) * ladder.step, volumes[row], 0))
+        asks.reverse()
+        return bids, asks
+
+class LadderBuilder:
+    # Превращает снимки одного стакана в LadderFrame. Без Qt: вызывается из потока стрима
+    # (или из GUI-потока для снимков, переданных напрямую). Предыдущий снимок хранится,
+    # поэтому при неизменной лестнице пересчитываются только изменившиеся строки.
+    def __init__(self, step, lot_size=1):
+        self.step = step if step and step > 0 else NANO // 100
+        self.lot_size = lot_size
+        self.snapshot = BookSnapshot()  # буфер снимка, который заполняет владелец построителя
+        self.frame = None
+        self._seq = 0
+        self._ask_levels = {}
+        self._bid_levels = {}
+
+    def build(self, snapshot):
+        # Кадр для BookSnapshot; None, если стакан пуст. Снимок только читается,
+        # после возврата его можно перезаполнять.
+        step = self.step
+        # Один проход по снимку: объёмы по тикам и уровни с максимальным объёмом
+        ask_levels, max_ask_tick = self._collect_levels(snapshot.ask_prices, snapshot.ask_quantities, snapshot.ask_count, step)
+        bid_levels, max_bid_tick = self._collect_levels(snapshot.bid_prices, snapshot.bid_quantities, snapshot.bid_count, step)
+        if not ask_levels and not bid_levels:
+            return None
+        all_ticks = ask_levels.keys() | bid_levels.keys()
+        min_tick = min(all_ticks)
+        max_tick = max(all_ticks)
+        # --- Найти лучший ask и bid для спреда ---
+        best_ask = min(ask_levels, default=None)
+        best_bid = max(bid_levels, default=None)
+        spread_row = PriceLadder.spread_row_for(max_tick, best_bid, best_ask)
+        markers = (best_ask, best_bid, max_ask_tick, max_bid_tick)
+        prev = self.frame
+        prev_ask_levels = self._ask_levels
+        prev_bid_levels = self._bid_levels
+        self._ask_levels = ask_levels
+        self._bid_levels = bid_levels
+        self._seq += 1
+
+        if prev is None or prev.structure != (step, min_tick, max_tick, spread_row):
+            # Диапазон цен или строка спреда сдвинулись — лестница строится целиком
+            ladder = PriceLadder(step, max_tick, min_tick, spread_row)
+            rows = len(ladder)
+            volumes = array('q', bytes(8 * rows))
+            sums = array('q', bytes(8 * rows))
+            zones = array('b', bytes(rows))
+            for row in range(rows):
+                self._fill_row(ladder, volumes, sums, zones, row)
+            self.frame = LadderFrame(self, self._seq, ladder, volumes, sums, zones, markers,
+                                     self._scan_range(volumes), self._scan_range(sums), None)
+            return self.frame
+
+        ladder = prev.ladder
+        changed = self._changed_ticks(prev_ask_levels, ask_levels)
+        changed |= self._changed_ticks(prev_bid_levels, bid_levels)
+        # Строки, у которых мог поменяться цвет (лучшие цены и максимумы)
+        changed.update(prev.markers)
+        changed.update(markers)
+        changed.discard(None)
+        rows = {ladder.row_of_tick(t) for t in changed}
+        rows.discard(-1)
+        # Предыдущий кадр мог уже уйти в GUI — массивы копируются, а не меняются на месте
+        volumes = prev.volumes[:]
+        sums = prev.sums[:]
+        zones = prev.zones[:]
+        volume_range = prev.volume_range
+        sum_range = prev.sum_range
+        for row in rows:
+            old_volume = volumes[row]
+            old_sum = sums[row]
+            self._fill_row(ladder, volumes, sums, zones, row)
+            volume_range = self._track_range(volume_range, old_volume, volumes[row])
+            sum_range = self._track_range(sum_range, old_sum, sums[row])
+        if volume_range is None:
+            volume_range = self._scan_range(volumes)
+        if sum_range is None:
+            sum_range = self._scan_range(sums)
+        prev_max_sum = prev.max_sum
+        max_sum = sum_range[1]
+        if max_sum != prev_max_sum:
+            # Отметка максимума суммы переезжает — перерисовать старые и новые строки с максимумом
+            rows.update(row for row, summa in enumerate(sums) if summa > 0 and summa in (prev_max_sum, max_sum))
+        self.frame = LadderFrame(self, self._seq, ladder, volumes, sums, zones, markers,
+                                 volume_range, sum_range, frozenset(rows))
+        return self.frame
+
+    def _fill_row(self, ladder, volumes, sums, zones, row):
+        tick = ladder.tick_of_row(row)
+        if tick is None:
+            volumes[row] = 0
+            sums[row] = 0
+            zones[row] = LadderFrame.ZONE_SPREAD
+            return
+        ask_volume = self._ask_levels.get(tick, 0)
+        bid_volume = self._bid_levels.get(tick, 0)
+        if ask_volume > 0:
+            volume, zone = ask_volume, LadderFrame.ZONE_ASK
+        elif bid_volume > 0:
+            volume, zone = bid_volume, LadderFrame.ZONE_BID
         else:
-            try:
-                value = int(index.data())
-            except (TypeError, ValueError):
-                value = 0
+            volume, zone = 0, LadderFrame.ZONE_EMPTY
+        volumes[row] = volume
+        # Сумма в копейках: цена (нано) * объём * лот, с округлением
+        sums[row] = (tick * ladder.step * volume * self.lot_size + 5 * 10 ** 6) // 10 ** 7 if volume > 0 else 0
+        zones[row] = zone
+
+    @staticmethod
+    def _scan_range(values):
+        return (min((v for v in values if v > 0), default=0), max(values, default=0))
+
+    @staticmethod
+    def _track_range(value_range, old, new):
+        # Обновить (минимум, максимум) при замене old -> new. Полный пересчёт нужен,
+        # только если ушло текущее крайнее значение (возвращается None).
+        if value_range is None or old == new:
+            return value_range
+        low, high = value_range
+        if old == high and new < old:
+            return None
+        if old == low and old > 0 and not 0 < new < low:
+            return None
+        if new > high:
+            high = new
+        if new > 0 and (low == 0 or new < low):
+            low = new
+        return (low, high)
+
+    @staticmethod
+    def _collect_levels(prices, quantities, count, step):
+        # Уровни стакана в виде {тик: объём} и тик первого уровня с максимальным объёмом
+        result = {}
+        max_tick = None
+        max_volume = None
+        half = step // 2
+        for i in range(count):
+            v = quantities[i]
+            tick = (prices[i] + half) // step
+            result[tick] = result.get(tick, 0) + v
+            if max_volume is None or v > max_volume:
+                max_volume = v
+                max_tick = tick
+        return result, max_tick
+
+    @staticmethod
+    def _changed_ticks(prev, current):
+        # Тики, которые появились, исчезли или у которых изменился объём
+        if not prev:
+            return set(current)
+        changed = {t for t, v in current.items() if prev.get(t) != v}
+        changed.update(t for t in prev if t not in current)
+        return changed
+
+# Роли модели стакана для делегата полос
+BAR_VALUE_ROLE = Qt.UserRole
+BAR_COLOR_ROLE = Qt.UserRole + 1
+
+class OrderBookModel(QAbstractTableModel):
+    # Модель стакана поверх готового LadderFrame (массивы по одному элементу на строку).
+    # Кадр только подставляется: dataChanged уходит для изменившихся строк,
+    # полный сброс модели — только когда сдвинулся диапазон цен или строка спреда.
+    ZONE_EMPTY = LadderFrame.ZONE_EMPTY
+    ZONE_ASK = LadderFrame.ZONE_ASK
+    ZONE_BID = LadderFrame.ZONE_BID
+    ZONE_SPREAD = LadderFrame.ZONE_SPREAD
+    # --- Цвета полос объёма/суммы (индекс — результат bar_kind) ---
+    BAR_ASK = 0
+    BAR_BID = 1
+    BAR_MAX = 2
+    BAR_NONE = 3
+    ASK_BAR_COLOR = QColor(180, 60, 60)
+    BID_BAR_COLOR = QColor(60, 180, 60)
+    MAX_BAR_COLOR = QColor(180, 140, 20)
+    SPREAD_BAR_COLOR = QColor(255, 180, 40)
+    BAR_COLORS = (ASK_BAR_COLOR, BID_BAR_COLOR, MAX_BAR_COLOR, SPREAD_BAR_COLOR)
+    # --- Цвета фона колонки с ценой ---
+    DEFAULT_BG_COLOR = QColor(24, 24, 24)
+    ASK_BG_COLOR = QColor(45, 35, 35)       # Приглушенный красный
+    BID_BG_COLOR = QColor(35, 45, 35)       # Приглушенный зелёный
+    BEST_ASK_BG_COLOR = QColor(80, 40, 40)  # Яркий красный
+    BEST_BID_BG_COLOR = QColor(40, 80, 40)  # Яркий зелёный
+    SPREAD_BG_COLOR = QColor(60, 60, 30)    # Цвет для спреда
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.volume_mode = True
+        self.price_decimals = 2
+        self.frame = None
+        self.blank_rows = 0
+
+    @property
+    def ladder(self):
+        return self.frame.ladder if self.frame is not None else None
+
+    def clear(self, blank_rows=0):
+        self.beginResetModel()
+        self.frame = None
+        self.blank_rows = blank_rows
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.frame) if self.frame is not None else self.blank_rows
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 2
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return ("Объём" if self.volume_mode else "Сумма", "Цена")[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        frame = self.frame
+        if frame is None or not index.isValid():
+            return None
         row = index.row()
-        color = self.row_colors[row] if row < len(self.row_colors) else QColor(255, 180, 40)
-        if self.max_vol > self.min_vol and value > 0:
-            ratio = (value - self.min_vol) / (self.max_vol - self.min_vol)
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if frame.zones[row] == self.ZONE_SPREAD:
+                return ""
+            if column == 1:
+                return format_nanos(self.price_of_row(row), self.price_decimals)
+            if self.volume_mode:
+                volume = frame.volumes[row]
+                return str(volume) if volume > 0 else ''
+            summa = frame.sums[row]
+            return format_nanos(summa * 10 ** 7) if summa > 0 else ''
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignLeft | Qt.AlignVCenter if column == 0 else Qt.AlignCenter
+        if role == Qt.BackgroundRole and column == 1:
+            return self.price_background(row)
+        if role == BAR_VALUE_ROLE and column == 0:
+            return self.bar_value(row)
+        if role == BAR_COLOR_ROLE and column == 0:
+            return self.BAR_COLORS[self.bar_kind(row)]
+        return None
+
+    def price_of_row(self, row):
+        ladder = self.frame.ladder
+        tick = ladder.tick_of_row(row)
+        return None if tick is None else tick * ladder.step
+
+    def bar_value(self, row):
+        return self.frame.volumes[row] if self.volume_mode else self.frame.sums[row]
+
+    def bar_kind(self, row):
+        frame = self.frame
+        zone = frame.zones[row]
+        if zone == self.ZONE_SPREAD or zone == self.ZONE_EMPTY:
+            return self.BAR_NONE
+        if self.volume_mode:
+            if row == frame.marker_rows[2 if zone == self.ZONE_ASK else 3]:
+                return self.BAR_MAX
+        elif frame.sums[row] == frame.max_sum:
+            return self.BAR_MAX
+        return self.BAR_ASK if zone == self.ZONE_ASK else self.BAR_BID
+
+    @property
+    def max_sum(self):
+        return self.frame.max_sum if self.frame is not None else 0
+
+    def price_background(self, row):
+        frame = self.frame
+        zone = frame.zones[row]
+        if zone == self.ZONE_SPREAD:
+            return self.SPREAD_BG_COLOR
+        if row == frame.marker_rows[0]:
+            return self.BEST_ASK_BG_COLOR
+        if row == frame.marker_rows[1]:
+            return self.BEST_BID_BG_COLOR
+        if zone == self.ZONE_ASK:
+            return self.ASK_BG_COLOR
+        if zone == self.ZONE_BID:
+            return self.BID_BG_COLOR
+        return self.DEFAULT_BG_COLOR
+
+    def bar_range(self):
+        return self.volume_range() if self.volume_mode else self.sum_range()
+
+    def volume_range(self):
+        return self.frame.volume_range if self.frame is not None else (0, 0)
+
+    def sum_range(self):
+        return self.frame.sum_range if self.frame is not None else (0, 0)
+
+    def set_volume_mode(self, volume_mode):
+        if volume_mode == self.volume_mode:
+            return
+        self.volume_mode = volume_mode
+        self.headerDataChanged.emit(Qt.Horizontal, 0, 0)
+        if self.rowCount():
+            self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount() - 1, 0))
+
+    def apply_frame(self, frame, changed_rows=None):
+        # Подставить готовый кадр. changed_rows — строки, отличающиеся от текущего кадра
+        # (None — неизвестно, перерисовать все). Возвращает True, если лестница перестроена.
+        prev = self.frame
+        if prev is None or frame.structure != prev.structure:
+            self.beginResetModel()
+            self.frame = frame
+            self.price_decimals = price_decimals(frame.ladder.step)
+            self.endResetModel()
+            return True
+        self.frame = frame
+        if changed_rows is None:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(frame) - 1, 1))
         else:
-            ratio = 0
-        if value > 0:
-            min_width = 4
-            bar_width = max(int(option.rect.width() * ratio), min_width)
-            bar_rect = option.rect.adjusted(0, 0, -option.rect.width() + bar_width, 0)
-            painter.save()
-            painter.setBrush(QColor(color))
-            painter.setOpacity(0.9)
-            painter.setPen(Qt.NoPen)
-            painter.drawRect(bar_rect)
-            painter.restore()
-        super().paint(painter, option, index)
+            self._emit_rows_changed(changed_rows)
+        return False
+
+    def _emit_rows_changed(self, rows):
+        # dataChanged по непрерывным диапазонам изменившихся строк
+        start = prev = None
+        for row in sorted(rows):
+            if start is None:
+                start = prev = row
+            elif row == prev + 1:
+                prev = row
+            else:
+                self.dataChanged.emit(self.index(start, 0), self.index(prev, 1))
+                start = prev = row
+        if start is not None:
+            self.dataChanged.emit(self.index(start, 0), self.index(prev, 1))
+
+class RenderScheduler(QObject):
+    # Один таймер отрисовки на все стаканы вместо постоянного 50 мс таймера в каждом.
+    # Стакан, получивший данные, просит кадр (request); таймер взводится на ближайший
+    # срок и останавливается, когда ждать нечего. За один тик обрабатываются стаканы,
+    # чей срок подошёл, самые просроченные первыми, пока не исчерпан бюджет кадра.
+    # Частота зависит от стакана: в фокусе — чаще, скрытый или свёрнутый — реже.
+    FOCUSED_INTERVAL = 0.016  # секунды, ~60 кадров в секунду
+    INTERVAL = 0.050
+    HIDDEN_INTERVAL = 0.500
+    FRAME_BUDGET = 0.008
+    TIMER_SLACK = 0.001  # таймер может сработать чуть раньше срока
+    _instance = None
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+    def __init__(self):
+        if self._initialized:
+            return
+        super().__init__()
+        self._pending = weakref.WeakSet()  # стаканы с необработанными данными
+        self._last_render = weakref.WeakKeyDictionary()
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._tick)
+        self.frames = 0
+        self.deferred = 0  # стаканов, отложенных на следующий тик из-за бюджета
+        app = QApplication.instance()
+        if app is not None:
+            app.focusChanged.connect(self.reschedule)
+        self._initialized = True
+    def request(self, book):
+        if book in self._pending:
+            return
+        self._pending.add(book)
+        self._schedule()
+    def reschedule(self, *args):
+        # Частота стаканов могла измениться (показ, фокус) — пересчитать ближайший срок
+        self._schedule()
+    def interval_for(self, book):
+        window = book.window()
+        if not book.isVisible() or window.isMinimized() or book.visibleRegion().isEmpty():
+            return self.HIDDEN_INTERVAL
+        focus = QApplication.focusWidget()
+        if focus is not None and window.isActiveWindow() and (focus is book or book.isAncestorOf(focus)):
+            return self.FOCUSED_INTERVAL
+        return self.INTERVAL
+    def _due(self, book):
+        return self._last_render.get(book, 0.0) + self.interval_for(book)
+    def _schedule(self):
+        if not self._pending:
+            self._timer.stop()
+            return
+        next_due = min(self._due(book) for book in self._pending)
+        delay = max(0, math.ceil((next_due - time.monotonic()) * 1000))
+        if not self._timer.isActive() or self._timer.remainingTime() > delay:
+            self._timer.start(delay)
+    def _tick(self):
+        started = time.monotonic()
+        due = sorted(((self._due(book), id(book), book) for book in self._pending), key=lambda item: item[:2])
+        for deadline, _, book in due:
+            now = time.monotonic()
+            if deadline > now + self.TIMER_SLACK:
+                break
+            if now - started > self.FRAME_BUDGET:
+                self.deferred += 1
+                break
+            self._pending.discard(book)
+            self._last_render[book] = now
+            book.render_pending()
+        self.frames += 1
+        self._schedule()
 
 class OrderBookWindow(QWidget):
+    # Цены в сигналах наружу (графику) — float, как и до перевода стакана на нано;
+    # нано остаются внутри стакана, перевод — только на этой границе
     trade_received = pyqtSignal(dict, int)
     visible_prices_changed = pyqtSignal(list, int, int)
     structure_changed = pyqtSignal(int, int, list)
     scroll_changed = pyqtSignal(int)
     price_label_updated = pyqtSignal(str)
-    data_from_stream = pyqtSignal(dict)
+    data_from_stream = pyqtSignal(object)  # LadderFrame, TradeTick или dict (снимок/сделка списками)
+    stale_changed = pyqtSignal(bool)
+
+    EVENT_BUFFER_SIZE = 8192
 
     def __init__(self, on_data_updated_callback=None):
         super().__init__()
-        self.current_price = 0.0
-        self.price_step = 0.01
+        self.current_price = 0
+        self.price_step_nanos = NANO // 100  # шаг цены в нано, 0.01 по умолчанию
         self.visible_rows = 20
         self.total_rows = 50
         self.streamer = None
@@ -135,15 +740,14 @@ class OrderBookWindow(QWidget):
         self.lot_size = 1
         self.all_prices = []
         self.on_data_updated_callback = on_data_updated_callback
-        self._pending_data = None
-        self._update_timer = QTimer(self)
-        self._update_timer.setInterval(50)  # 20 раз в секунду
-        self._update_timer.timeout.connect(self._update_from_buffer)
-        self._update_timer.start()
-        self._volumes = []
-        self._vol_colors = []
-        self._sums = []
-        self._sum_colors = []
+        # Кольцевой буфер событий стрима: ничего не теряется между кадрами
+        self._events = deque(maxlen=self.EVENT_BUFFER_SIZE)
+        self.dropped_events = 0
+        # Кадры отрисовывает общий планировщик, и только когда есть новые данные
+        self._scheduler = RenderScheduler()
+        self._chart_update_pending = False
+        self._bar_range = None
+        self._builder = None  # построитель кадров для снимков, переданных напрямую
 
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
@@ -153,6 +757,14 @@ class OrderBookWindow(QWidget):
         self.price_label.setStyleSheet("font-size: 16px; font-weight: bold; color: #C0C0C0; background: #232323;")
         self.price_label.hide()
         layout.addWidget(self.price_label)
+
+        # --- Статус стрима (переподключение) ---
+        self.stale = False
+        self.status_label = QLabel("Нет связи — переподключение...")
+        self.status_label.setAlignment(Qt.AlignCenter)
+        self.status_label.setStyleSheet("color: #ffb428; background: #2a2418; padding: 2px;")
+        self.status_label.hide()
+        layout.addWidget(self.status_label)
         
         # --- Кнопка-переключатель ---
         self.volume_mode = True  # True = 'Объём', False = 'Сумма'
@@ -162,16 +774,19 @@ class OrderBookWindow(QWidget):
         self.toggle_button.clicked.connect(self.toggle_volume_sum)
         layout.addWidget(self.toggle_button)
         
-        self.table = QTableWidget()
-        self.table.setColumnCount(2)
-        self.table.setHorizontalHeaderLabels(["Объём", "Цена"])
-        self.table.setRowCount(self.total_rows)
-        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.model = OrderBookModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self._bar_delegate = VolumeBarDelegate(self.model, parent=self.table)
+        self.table.setItemDelegateForColumn(0, self._bar_delegate)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.table.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.table.setVerticalScrollMode(QTableWidget.ScrollPerPixel)
+        self.table.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
         
         self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
         self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        # Все строки одной высоты — без setRowHeight на каждую строку
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
         
         self.init_empty_order_book()
         layout.addWidget(self.table)
@@ -180,218 +795,110 @@ class OrderBookWindow(QWidget):
         self.apply_dark_style()
         
         QShortcut(QKeySequence(Qt.Key_Space), self).activated.connect(self.center_to_current_price)
+        # Задержки от биржи до стакана: оверлей и выгрузка гистограмм в JSON
+        self.latency_overlay = LatencyOverlay(self)
+        # Контекст — только этот стакан: окна стаканов живут в одном родителе
+        for keys, slot in (("Ctrl+L", self.latency_overlay.toggle), ("Ctrl+Shift+L", self.export_latency)):
+            shortcut = QShortcut(QKeySequence(keys), self)
+            shortcut.setContext(Qt.WidgetWithChildrenShortcut)
+            shortcut.activated.connect(slot)
     
         self.table.verticalHeader().setVisible(False)
         self.table.horizontalHeader().setVisible(True)
 
-        self.update_chart_timer = QTimer(self)
-        self.update_chart_timer.setSingleShot(True)
-        self.update_chart_timer.setInterval(50)
-        self.update_chart_timer.timeout.connect(self.send_visible_prices_to_chart)
-
         self.table.verticalScrollBar().valueChanged.connect(self.scroll_changed)
 
         self.data_from_stream.connect(self.on_data_updated)
+        self.stale_changed.connect(self.set_stale)
 
     def apply_dark_style(self):
         self.setStyleSheet('''
             QMainWindow, QWidget { background: #181818; color: #C0C0C0; font-family: Consolas, monospace; font-size: 13px; }
-            QTableWidget { background: #232323; color: #C0C0C0; border: 1px solid #333; gridline-color: #333; }
+            QTableView { background: #232323; color: #C0C0C0; border: 1px solid #333; gridline-color: #333; }
             QHeaderView::section { background: #232323; color: #C0C0C0; border: 1px solid #333; font-weight: bold; }
             QLabel { color: #C0C0C0; }
         ''')
         self.table.setStyleSheet('''
-            QTableWidget { background: #232323; color: #C0C0C0; }
-            QTableWidget::item { padding: 2px; }
+            QTableView { background: #232323; color: #C0C0C0; }
+            QTableView::item { padding: 2px; }
         ''')
         self.price_label.setStyleSheet("font-size: 16px; font-weight: bold; color: #C0C0C0; background: #232323;")
     
     def init_empty_order_book(self):
-        self.table.setRowCount(self.total_rows)
-        for row in range(self.total_rows):
-            for col in range(2):
-                item = QTableWidgetItem("")
-                item.setTextAlignment(Qt.AlignCenter)
-                self.table.setItem(row, col, item)
+        self.all_prices = []
+        self.model.clear(self.total_rows)
     
     def set_price_range_callback(self, callback):
         self._price_range_callback = callback
 
+    @label('update_order_book')
     def update_order_book(self, bids, asks):
         self.last_bids = bids
         self.last_asks = asks
         if not bids and not asks:
             self.init_empty_order_book()
             return
-        self.price_step = self.price_step if self.price_step and self.price_step > 0 else 0.01
-
-        all_prices_set = set()
-        if bids:
-            for p, _, _ in bids: all_prices_set.add(p)
-        if asks:
-            for p, _, _ in asks: all_prices_set.add(p)
-        if not all_prices_set: return
+        builder = self.ladder_builder()
+        frame = builder.build(builder.snapshot.set_levels(bids, asks))
+        if frame is not None:
+            self.apply_frames([frame])
 
-        min_price = min(all_prices_set)
-        max_price = max(all_prices_set)
+    def ladder_builder(self):
+        # Построитель кадров в GUI-потоке; стрим строит кадры сам (StreamManager.ladder_builders)
+        if not self.price_step_nanos or self.price_step_nanos <= 0:
+            self.price_step_nanos = NANO // 100
+        builder = self._builder
+        if builder is None or builder.step != self.price_step_nanos or builder.lot_size != self.lot_size:
+            builder = self._builder = LadderBuilder(self.price_step_nanos, self.lot_size)
+        return builder
 
-        all_prices = []
-        current_price = min_price
-        while current_price <= max_price + self.price_step / 2:
-            all_prices.append(round(current_price, 2))
-            current_price += self.price_step
-        if not all_prices: all_prices = [round(min_price, 2)]
-
-        # --- Найти лучший ask и bid для спреда ---
-        best_ask = min([p for p, _, _ in asks], default=None)
-        best_bid = max([p for p, _, _ in bids], default=None)
-        # --- Вставить пустую строку для спреда ---
-        prices_with_spread = []
-        spread_inserted = False
-        for price in reversed(all_prices):
-            if best_bid is not None and best_ask is not None and not spread_inserted and price < best_ask and price > best_bid:
-                prices_with_spread.append(None)  # None = строка-спред
-                spread_inserted = True
-            prices_with_spread.append(price)
-        self.all_prices = prices_with_spread
-        self.table.setRowCount(len(self.all_prices))
-        row_height = self.table.verticalHeader().minimumSectionSize()
-        for i in range(self.table.rowCount()):
-            self.table.setRowHeight(i, row_height)
-        self.structure_changed.emit(self.table.rowCount(), row_height, self.all_prices)
-
-        # --- Заполнение массивов объёма, суммы и цветов ---
-        self._volumes = []
-        self._sums = []
-        self._vol_colors = []
-        self._sum_colors = []
-        ask_zone_color_volume = QColor(180, 60, 60)
-        bid_zone_color_volume = QColor(60, 180, 60)
-        dark_yellow = QColor(180, 140, 20)
-        orange = QColor(255, 180, 40)
-        # Найти максимальные объёмы и суммы
-        max_ask_volume = max([v for _, v, _ in asks], default=0)
-        max_bid_volume = max([v for _, v, _ in bids], default=0)
-        max_ask_price = None
-        max_bid_price = None
-        for p, v, _ in asks:
-            if v == max_ask_volume:
-                max_ask_price = p
-                break
-        for p, v, _ in bids:
-            if v == max_bid_volume:
-                max_bid_price = p
-                break
-        temp_sums = []
-        for price in self.all_prices:
-            if price is None:
-                self._volumes.append(0)
-                self._sums.append(0)
-                self._vol_colors.append(orange)
-                self._sum_colors.append(orange)
-                continue
-            ask_volume = sum(v for p, v, _ in asks if self.price_equal(p, price, self.price_step))
-            bid_volume = sum(v for p, v, _ in bids if self.price_equal(p, price, self.price_step))
-            volume = ask_volume if ask_volume > 0 else bid_volume
-            self._volumes.append(volume)
-            try:
-                lot_size = getattr(self, 'lot_size', 1)
-            except Exception:
-                lot_size = 1
-            summa = price * volume * lot_size if volume > 0 else 0
-            self._sums.append(summa)
-            temp_sums.append(summa)
-            # Цвета для объёма
-            if ask_volume > 0 and price == max_ask_price:
-                self._vol_colors.append(dark_yellow)
-            elif bid_volume > 0 and price == max_bid_price:
-                self._vol_colors.append(dark_yellow)
-            elif ask_volume > 0:
-                self._vol_colors.append(ask_zone_color_volume)
-            elif bid_volume > 0:
-                self._vol_colors.append(bid_zone_color_volume)
-            else:
-                self._vol_colors.append(orange)
-            # Цвета для суммы (пока как для объёма, потом скорректируем максимум)
-            if ask_volume > 0:
-                self._sum_colors.append(ask_zone_color_volume)
-            elif bid_volume > 0:
-                self._sum_colors.append(bid_zone_color_volume)
-            else:
-                self._sum_colors.append(orange)
-        # Найдём максимум суммы среди всех (кроме None)
-        max_sum = max([s for i, s in enumerate(self._sums) if self.all_prices[i] is not None], default=0)
-        for idx, price in enumerate(self.all_prices):
-            if price is None:
-                continue
-            if self._sums[idx] == max_sum and self._sums[idx] > 0:
-                self._sum_colors[idx] = dark_yellow
-
-        for row, price in enumerate(self.all_prices):
-            # Вторая колонка всегда цена!
-            if price is None:
-                price_item = QTableWidgetItem("")
-            else:
-                price_item = QTableWidgetItem(f"{price:,.2f}")
-            price_item.setTextAlignment(Qt.AlignCenter)
-            self.table.setItem(row, 1, price_item)
-        self.update_first_column()
-
-        # --- Окраска фона ячейки с ценой (вторая колонка) ---
-        default_bg_color = QColor(24, 24, 24)
-        ask_zone_color = QColor(45, 35, 35)    # Приглушенный красный
-        bid_zone_color = QColor(35, 45, 35)    # Приглушенный зелёный
-        best_ask_color = QColor(80, 40, 40)    # Яркий красный
-        best_bid_color = QColor(40, 80, 40)    # Яркий зелёный
-        spread_color = QColor(60, 60, 30)      # Цвет для спреда
-
-        for row, price in enumerate(self.all_prices):
-            if price is None:
-                bg_color = spread_color
-            else:
-                ask_volume = sum(v for p, v, _ in asks if self.price_equal(p, price, self.price_step))
-                bid_volume = sum(v for p, v, _ in bids if self.price_equal(p, price, self.price_step))
-                bg_color = default_bg_color
-                if ask_volume > 0:
-                    bg_color = ask_zone_color
-                if bid_volume > 0:
-                    bg_color = bid_zone_color
-                if best_ask is not None and self.price_equal(price, best_ask, self.price_step):
-                    bg_color = best_ask_color
-                if best_bid is not None and self.price_equal(price, best_bid, self.price_step):
-                    bg_color = best_bid_color
-            item = self.table.item(row, 1)
-            if item is not None:
-                item.setBackground(bg_color)
+    def apply_frames(self, frames):
+        # Кадры, пришедшие за тик, по порядку. Показывается последний; перерисовываются
+        # строки, изменившиеся по всей цепочке, если она непрерывна от текущего кадра модели.
+        prev = self.model.frame
+        changed_rows = set()
+        for frame in frames:
+            if changed_rows is not None:
+                if (prev is None or frame.changed_rows is None or frame.source is not prev.source
+                        or frame.seq != prev.seq + 1):
+                    changed_rows = None
+                else:
+                    changed_rows |= frame.changed_rows
+            prev = frame
+        if self.model.apply_frame(frames[-1], changed_rows):
+            # Диапазон цен или строка спреда сдвинулись
+            self.all_prices = self.model.ladder.prices()
+            row_height = self.table.verticalHeader().minimumSectionSize()
+            self.table.verticalHeader().setDefaultSectionSize(row_height)
+            self.structure_changed.emit(self.model.rowCount(), row_height,
+                                        [None if price is None else price / NANO for price in self.all_prices])
+            self.update_first_column()
+        else:
+            self._update_bar_range()
 
     def highlight_current_price(self):
         pass
     
     def center_to_current_price(self):
-        for row, price in enumerate(self.all_prices):
-            if self.price_equal(price, self.current_price, self.price_step):
-                self.table.scrollToItem(self.table.item(row, 0), QAbstractItemView.PositionAtCenter)
-                break
+        if self.model.ladder is None:
+            return
+        row = self.model.ladder.row_of_price(self.current_price)
+        if row != -1:
+            self.table.scrollTo(self.model.index(row, 0), QAbstractItemView.PositionAtCenter)
     
     def get_visible_prices(self):
         first_row = self.table.rowAt(0)
         last_row = self.table.rowAt(self.table.viewport().height() - 1)
         if first_row == -1: first_row = 0
-        if last_row == -1: last_row = self.table.rowCount() - 1
+        if last_row == -1: last_row = self.model.rowCount() - 1
         
-        prices = []
-        for row in range(first_row, last_row + 1):
-            item = self.table.item(row, 1)
-            if item:
-                try: prices.append(float(item.text()))
-                except (ValueError, AttributeError): pass
-        return prices
+        return [price / NANO for price in self.all_prices[first_row:last_row + 1] if price is not None]
     
     def eventFilter(self, source, event):
         if event.type() == event.Wheel and source is self.table:
             scroll_bar = self.table.verticalScrollBar()
             scroll_bar.setValue(scroll_bar.value() - event.angleDelta().y())
-            self.update_chart_timer.start()
+            self.request_chart_update()
             return True
         return super().eventFilter(source, event)
 
@@ -406,42 +913,118 @@ class OrderBookWindow(QWidget):
     def stop_stream(self):
         if hasattr(self, 'stream_manager'):
             self.stream_manager.unregister(self.figi)
+        self.set_stale(False)
 
     def on_data_updated(self, data):
-        self._pending_data = data
+        if len(self._events) == self._events.maxlen:
+            self.dropped_events += 1
+        self._events.append(data)
+        self._scheduler.request(self)
+
+    def request_chart_update(self):
+        # Видимые цены уйдут графику в ближайшем кадре планировщика
+        self._chart_update_pending = True
+        self._scheduler.request(self)
 
+    def render_pending(self):
+        # Кадр от RenderScheduler: применить накопленные события и обновить график
+        self._update_from_buffer()
+        if self._chart_update_pending:
+            self._chart_update_pending = False
+            self.send_visible_prices_to_chart()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self._scheduler.reschedule()
+
+    @label('order_book_frame')
     def _update_from_buffer(self):
-        if self._pending_data is not None:
-            data = self._pending_data
-            self._pending_data = None
-            bids = data.get('bids', [])
-            asks = data.get('asks', [])
-            if bids or asks:
-                self.update_order_book(bids, asks)
-            if 'trade' in data:
-                trade = data['trade']
-                self.current_price = trade['price']
-                direction = "↑" if trade['direction'] == TradeDirection.TRADE_DIRECTION_BUY else "↓"
-                label_text = f"Текущая цена: {self.current_price:.2f} {direction} "
-                self.price_label_updated.emit(label_text)
-                trade_row_index = -1
-                for i, price in enumerate(self.all_prices):
-                    if self.price_equal(price, trade['price'], self.price_step):
-                        trade_row_index = i
-                        break
-                if trade_row_index != -1:
-                    self.trade_received.emit(trade, trade_row_index)
-                self.update_chart_timer.start()
+        # Забираем всё, что пришло за кадр: стаканы схлопываются до последнего,
+        # сделки сохраняются все и агрегируются
+        events = self._events
+        if not events:
+            return
+        stamped = [] if LATENCY.enabled else None
+        picked_up = time.monotonic_ns() if stamped is not None else 0
+        book = None
+        frames = []
+        trades = []
+        for _ in range(len(events)):
+            data = events.popleft()
+            if isinstance(data, LadderFrame):
+                frames.append(data)
+                if stamped is not None and data.stamps is not None:
+                    stamped.append(data.stamps)
+            elif isinstance(data, TradeTick):
+                trades.append(data)
+                if stamped is not None and data.stamps is not None:
+                    stamped.append(data.stamps)
+            else:
+                # Словарь со списками уровней и/или сделкой (OrderBookStreamer, внешние источники)
+                if data.get('bids') or data.get('asks'):
+                    book = data
+                if 'trade' in data:
+                    trades.append(TradeTick.from_dict(data['trade']))
             if self.on_data_updated_callback:
-                self.on_data_updated_callback(data)
+                self.on_data_updated_callback(self._stream_dict(data))
+        if frames:
+            self.apply_frames(frames)
+        if book is not None:
+            self.update_order_book(book.get('bids', []), book.get('asks', []))
+        if trades:
+            self._apply_trades(trades)
+        if stamped:
+            LATENCY.record(self.figi, stamped, picked_up, time.monotonic_ns())
+
+    @staticmethod
+    def _stream_dict(data):
+        # Событие для on_data_updated_callback в прежнем виде словаря стрима: уровни
+        # (цена, объём, 0) и сделка, цены — float, как в сигналах окна
+        if isinstance(data, LadderFrame):
+            bids, asks = data.levels()
+            return {'bids': [(price / NANO, quantity, flag) for price, quantity, flag in bids],
+                    'asks': [(price / NANO, quantity, flag) for price, quantity, flag in asks]}
+        if isinstance(data, TradeTick):
+            return {'trade': dict(data.as_dict(), price=data.price / NANO)}
+        return data
+
+    def export_latency(self):
+        path = LATENCY.export_file()
+        print(f"[INFO] Задержки стаканов сохранены: {path}")
+
+    def _apply_trades(self, trades):
+        ladder = self.model.ladder
+        for trade in self._aggregate_trades(trades):
+            trade_row_index = ladder.row_of_price(trade.price) if ladder is not None else -1
+            if trade_row_index != -1:
+                self.trade_received.emit(dict(trade.as_dict(), price=trade.price / NANO), trade_row_index)
+        last = trades[-1]
+        self.current_price = last.price
+        direction = "↑" if last.direction == TradeDirection.TRADE_DIRECTION_BUY else "↓"
+        label_text = f"Текущая цена: {format_nanos(self.current_price, price_decimals(self.price_step_nanos), grouping=False)} {direction} "
+        self.price_label_updated.emit(label_text)
+        self._chart_update_pending = True
+
+    @staticmethod
+    def _aggregate_trades(trades):
+        # Подряд идущие сделки по одной цене и в одну сторону объединяются, объём суммируется
+        result = []
+        for trade in trades:
+            prev = result[-1] if result else None
+            if prev is not None and prev.price == trade.price and prev.direction == trade.direction:
+                prev.quantity += trade.quantity
+                prev.count += trade.count
+            else:
+                result.append(TradeTick(trade.price, trade.quantity, trade.direction, trade.count))
+        return result
 
     def on_stream_error(self, msg):
         pass
 
-    def price_equal(self, p1, p2, step):
-        if p1 is None or p2 is None:
-            return False
-        return abs(round(p1 - p2, 6)) < step / 2
+    def set_stale(self, stale):
+        # Данные стакана устарели: стрим переподключается, ждём первый свежий снимок
+        self.stale = stale
+        self.status_label.setVisible(stale)
 
     def send_visible_prices_to_chart(self):
         if not self.table.isVisible():
@@ -467,43 +1050,24 @@ class OrderBookWindow(QWidget):
         self.volume_mode = not self.volume_mode
         if self.volume_mode:
             self.toggle_button.setText('Показать сумму')
-            self.table.setHorizontalHeaderLabels(["Объём", "Цена"])
         else:
             self.toggle_button.setText('Показать объём')
-            self.table.setHorizontalHeaderLabels(["Сумма", "Цена"])
         # Обновить только первую колонку
+        self.model.set_volume_mode(self.volume_mode)
         self.update_first_column()
 
     def update_first_column(self):
-        if not hasattr(self, '_volumes') or not hasattr(self, '_sums') or not self._volumes or not self._sums:
+        if self.model.ladder is None:
             return
-        if self.volume_mode:
-            min_vol = min([v for i, v in enumerate(self._volumes) if v > 0 and self.all_prices[i] is not None], default=0)
-            max_vol = max([v for i, v in enumerate(self._volumes) if self.all_prices[i] is not None], default=0)
-            delegate = VolumeBarDelegate(min_vol, max_vol, self._vol_colors, is_sum_mode=False, parent=self.table)
-            self.table.setItemDelegateForColumn(0, delegate)
-            for row, value in enumerate(self._volumes):
-                if self.all_prices[row] is None:
-                    item = QTableWidgetItem("")
-                else:
-                    text = str(int(value)) if value > 0 else ''
-                    item = QTableWidgetItem(text)
-                item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-                self.table.setItem(row, 0, item)
-        else:
-            min_sum = min([s for i, s in enumerate(self._sums) if s > 0 and self.all_prices[i] is not None], default=0)
-            max_sum = max([s for i, s in enumerate(self._sums) if self.all_prices[i] is not None], default=0)
-            delegate = VolumeBarDelegate(min_sum, max_sum, self._sum_colors, is_sum_mode=True, parent=self.table)
-            self.table.setItemDelegateForColumn(0, delegate)
-            for row, summa in enumerate(self._sums):
-                if self.all_prices[row] is None:
-                    item = QTableWidgetItem("")
-                else:
-                    text = f"{summa:,.2f}" if summa > 0 else ''
-                    item = QTableWidgetItem(text)
-                    item.setData(Qt.UserRole, summa)
-                item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-                self.table.setItem(row, 0, item)
+        self._bar_range = tuple(self.model.bar_range())
+        self.table.viewport().update()
+
+    def _update_bar_range(self):
+        # Все полосы перерисовываются, только если сменился масштаб
+        bar_range = tuple(self.model.bar_range())
+        if bar_range != self._bar_range:
+            self._bar_range = bar_range
+            self.table.viewport().update()
 
 # Этот класс больше не используется напрямую в main.py, но мы оставляем его здесь.
 class OrderBook(QTableWidget):
@@ -570,7 +1134,270 @@ class OrderBook(QTableWidget):
         self.trade_signal.emit(trade_data)
 
 # --- StreamManager ---
+class MarketDataShard:
+    # Один постоянный market_data_stream для части FIGI менеджера. Стрим работает на своей
+    # полосе пула подключений (поток, event loop и долгоживущий канал, см. connection_pool.py).
+    # Подписки добавляются и снимаются отдельными сообщениями через очередь запросов,
+    # без переподключения. При обрыве стрим переподключается с экспоненциальной задержкой
+    # и джиттером, переподписывается на свои FIGI и помечает их устаревшими до первого снимка.
+    RECONNECT_BASE_DELAY = 0.5  # секунды
+    RECONNECT_MAX_DELAY = 30.0
+
+    def __init__(self, manager, index):
+        self.manager = manager
+        self.index = index
+        self.figis = set()
+        self.running = False
+        self._lane = None
+        self._loop = None
+        self._future = None
+        self._task = None
+        self._requests = None  # asyncio.Queue в потоке стрима: (action, [figi]) или None для остановки
+        self._subscribed = set()
+        # FIGI, по которым после переподключения ещё не пришёл снимок. Меняют его поток стрима
+        # и GUI-поток (remove, restart), поэтому под замком и заменой: читать можно без замка
+        self._stale = frozenset()
+        self._stale_lock = threading.Lock()
+        self.reconnect_count = 0
+        self.last_error = None
+        self._last_message_time = None
+        self._received = False  # было ли сообщение в текущем подключении
+    def add(self, figi):
+        self.figis.add(figi)
+        if not self.running:
+            self.start()
+        else:
+            self._send(SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, [figi])
+    def remove(self, figi):
+        self.figis.discard(figi)
+        self._set_stale(figi, False)
+        if not self.figis:
+            self.stop()
+        else:
+            self._send(SubscriptionAction.SUBSCRIPTION_ACTION_UNSUBSCRIBE, [figi])
+    @property
+    def lane_name(self):
+        return f"market-data-shard-{self.index}"
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._lane = ConnectionPool.lane(self.manager.token, self.lane_name)
+        self._loop = self._lane.loop
+        self._requests = None
+        self._future = self._lane.submit(self._async_stream())
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        try:
+            self._loop.call_soon_threadsafe(self._shutdown)
+        except RuntimeError:
+            pass  # цикл уже закрыт
+        if self._future is not None and self._lane.thread is not threading.current_thread():
+            try:
+                self._future.result(timeout=2)
+            except Exception:
+                pass
+        self._future = None
+    def close(self):
+        # Шард больше не нужен: остановить стрим и закрыть канал его полосы
+        self.stop()
+        ConnectionPool.release(self.manager.token, self.lane_name)
+    def last_message_age(self):
+        # Секунды с последнего сообщения стрима (None — сообщений ещё не было)
+        if self._last_message_time is None:
+            return None
+        return time.monotonic() - self._last_message_time
+    def stats(self):
+        return {
+            'shard': self.index,
+            'running': self.running,
+            'figis': len(self.figis),
+            'reconnect_count': self.reconnect_count,
+            'channel_connects': self._lane.connects if self._lane is not None else 0,
+            'last_message_age': self.last_message_age(),
+            'last_error': self.last_error,
+            'stale': sorted(self._stale),
+        }
+    def _send(self, action, figis):
+        # Вызывается из GUI-потока: запрос уходит в очередь потока стрима
+        if not self.running or self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._enqueue, (action, list(figis)))
+        except RuntimeError:
+            pass
+    def _request_queue(self):
+        # Очередь создаётся уже внутри работающего цикла стрима (своя на каждое подключение)
+        if self._requests is None:
+            self._requests = asyncio.Queue()
+        return self._requests
+    def _enqueue(self, item):
+        self._request_queue().put_nowait(item)
+    def _shutdown(self):
+        self._request_queue().put_nowait(None)
+        if self._task is not None:
+            self._task.cancel()
+    def _subscription_requests(self, action, figis):
+        # Отфильтровать уже применённые подписки и собрать запросы на стаканы и сделки
+        if action == SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE:
+            figis = [figi for figi in figis if figi not in self._subscribed]
+            self._subscribed.update(figis)
+        else:
+            figis = [figi for figi in figis if figi in self._subscribed]
+            self._subscribed.difference_update(figis)
+        if not figis:
+            return []
+        return [
+            MarketDataRequest(
+                subscribe_order_book_request=SubscribeOrderBookRequest(
+                    subscription_action=action,
+                    instruments=[OrderBookInstrument(instrument_id=figi, depth=50) for figi in figis]
+                )
+            ),
+            MarketDataRequest(
+                subscribe_trades_request=SubscribeTradesRequest(
+                    subscription_action=action,
+                    instruments=[TradeInstrument(instrument_id=figi) for figi in figis]
+                )
+            ),
+        ]
+    async def _request_iterator(self):
+        queue = self._request_queue()
+        self._subscribed = set()
+        ping_settings = ping_settings_request()
+        if ping_settings is not None:
+            yield ping_settings
+        for request in self._subscription_requests(SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, list(self.figis)):
+            yield request
+        # Просыпаемся только на изменение подписок или остановку (None)
+        while self.running:
+            item = await queue.get()
+            if item is None:
+                break
+            for request in self._subscription_requests(*item):
+                yield request
+    def _set_stale(self, figi, stale):
+        # -> True, если пометка FIGI изменилась
+        with self._stale_lock:
+            if (figi in self._stale) == stale:
+                return False
+            self._stale = self._stale | {figi} if stale else self._stale - {figi}
+            return True
+    def _mark_stale(self):
+        for figi in list(self.figis):
+            orderbook_window = self.manager.figi_to_orderbook.get(figi)
+            if orderbook_window is not None and self._set_stale(figi, True):
+                orderbook_window.stale_changed.emit(True)
+    def _reconnect_delay(self, attempt):
+        return reconnect_delay(attempt, self.RECONNECT_BASE_DELAY, self.RECONNECT_MAX_DELAY)
+    async def _async_stream(self):
+        # Супервизор: держит стрим открытым, пока у шарда есть подписанные стаканы
+        self._task = asyncio.current_task()
+        attempt = 0
+        while self.running:
+            try:
+                await self._stream_once()
+                self.last_error = "stream closed by server"
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.last_error = str(e)
+            if not self.running:
+                break
+            # Удачное подключение с данными сбрасывает задержку, даже если стрим затем оборвался
+            attempt = 0 if self._received else attempt + 1
+            self.reconnect_count += 1
+            self._mark_stale()
+            try:
+                await asyncio.sleep(self._reconnect_delay(attempt))
+            except asyncio.CancelledError:
+                break
+    async def _stream_once(self):
+        # Одно подключение: подписка на все текущие FIGI и чтение до обрыва или до
+        # срабатывания сторожа тишины. _received — пришло ли хотя бы одно сообщение; его читает
+        # супервизор и после обрыва с исключением.
+        self._received = False
+        self._requests = asyncio.Queue()
+        # Канал полосы переживает переподключения стрима: заново открывается только сам стрим
+        client = await self._lane.services()
+        reader = asyncio.ensure_future(self._read_stream(client))
+        watchdog = asyncio.ensure_future(self._watchdog())
+        try:
+            done, _ = await asyncio.wait({reader, watchdog}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            reader.cancel()
+            watchdog.cancel()
+        if reader not in done:
+            # Тишина дольше таймаута — соединение, скорее всего, мёртвое: канал пересоздаётся
+            await self._lane.reset()
+            raise TimeoutError(f"no data or pings for {STREAM_IDLE_TIMEOUT:.0f} s")
+        reader.result()
+    async def _watchdog(self):
+        # Сервер пингует стрим каждые STREAM_PING_DELAY_MS, поэтому долгая тишина — мёртвое
+        # соединение. Сторож спит до ближайшего возможного таймаута, а не опрашивает.
+        started = time.monotonic()
+        while True:
+            last = max(self._last_message_time or started, started)
+            remaining = last + STREAM_IDLE_TIMEOUT - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+    @label('stream_decode')
+    async def _read_stream(self, client):
+        stream = client.market_data_stream.market_data_stream(self._request_iterator())
+        async for response in stream:
+            if not self.running:
+                break
+            stamps = LatencyStamps() if LATENCY.enabled else None
+            self._received = True
+            self._last_message_time = time.monotonic()
+            recorder = self.manager.recorder
+            # Определяем FIGI
+            figi = None
+            if hasattr(response, 'orderbook') and response.orderbook is not None:
+                figi = response.orderbook.figi
+            elif hasattr(response, 'trade') and response.trade is not None:
+                figi = response.trade.figi
+            orderbook_window = self.manager.figi_to_orderbook.get(figi) if figi else None
+            if orderbook_window is None:
+                continue
+            # Наружу уходят готовые объекты: кадр лестницы или сделка, без промежуточных словарей
+            if hasattr(response, 'orderbook') and response.orderbook is not None:
+                if figi in self._stale and self._set_stale(figi, False):
+                    orderbook_window.stale_changed.emit(False)
+                # Лестница собирается здесь, в потоке стрима; снимок заполняется на месте
+                builder = self.manager.ladder_builders.get(figi)
+                frame = builder.build(builder.snapshot.fill(response.orderbook)) if builder is not None else None
+                if frame is not None:
+                    if stamps is not None:
+                        stamps.set_exchange_time(getattr(response.orderbook, 'time', None))
+                        stamps.emitted = time.monotonic_ns()
+                        frame.stamps = stamps
+                    orderbook_window.data_from_stream.emit(frame)
+                    # Запись — после отправки кадра, чтобы не задерживать стакан
+                    if recorder is not None:
+                        recorder.record_order_book(figi, builder.snapshot)
+            if hasattr(response, 'trade') and response.trade is not None:
+                trade = response.trade
+                if trade.price is not None:
+                    tick = TradeTick(trade.price.units * NANO + trade.price.nano, trade.quantity, int(trade.direction))
+                    if stamps is not None:
+                        stamps.set_exchange_time(getattr(trade, 'time', None))
+                        stamps.emitted = time.monotonic_ns()
+                        tick.stamps = stamps
+                    orderbook_window.data_from_stream.emit(tick)
+                    if recorder is not None:
+                        recorder.record_trade(figi, tick.price, tick.quantity, tick.direction)
+
 class StreamManager(QObject):
+    # Раздаёт стаканы по шардам (MarketDataShard): у каждого шарда свой стрим, поток и
+    # event loop, данные всех шардов сходятся в очереди событий стаканов (data_from_stream).
+    # shard_size — сколько FIGI держать в одном стриме; 0 — все FIGI в одном стриме.
+    # recorder — необязательный MarketRecorder (market_recorder.py), пишет все стаканы и сделки.
+    SHARD_SIZE = 0
+    recorder = None
     _instance = None
     def __new__(cls, token):
         if cls._instance is None:
@@ -583,79 +1410,90 @@ class StreamManager(QObject):
         super().__init__()
         self.token = token
         self.figi_to_orderbook = {}  # figi: OrderBookWindow
-        self.running = False
-        self.thread = None
+        self.ladder_builders = {}  # figi: LadderBuilder, используется только потоком шарда
+        self.shard_size = self.SHARD_SIZE
+        self.shards = []
+        self._figi_to_shard = {}
         self._initialized = True
+    @property
+    def running(self):
+        return any(shard.running for shard in self.shards)
+    @property
+    def reconnect_count(self):
+        return sum(shard.reconnect_count for shard in self.shards)
     def register(self, figi, orderbook):
         self.figi_to_orderbook[figi] = orderbook
-        self.restart()
+        self.ladder_builders[figi] = LadderBuilder(orderbook.price_step_nanos, orderbook.lot_size)
+        if self.recorder is not None:
+            self.recorder.register(figi, orderbook.price_step_nanos, orderbook.lot_size)
+        if figi not in self._figi_to_shard:
+            shard = self._shard_for_new_figi()
+            self._figi_to_shard[figi] = shard
+            shard.add(figi)
     def unregister(self, figi):
         if figi in self.figi_to_orderbook:
             del self.figi_to_orderbook[figi]
-            self.restart()
+            self.ladder_builders.pop(figi, None)
+            shard = self._figi_to_shard.pop(figi, None)
+            if shard is not None:
+                shard.remove(figi)
+                if not shard.figis:
+                    self.shards.remove(shard)
+                    shard.close()
+    def set_shard_size(self, shard_size):
+        # Перераспределить текущие подписки по шардам нового размера
+        self.shard_size = max(0, int(shard_size))
+        self.restart()
     def start(self):
-        self.running = True
-        self.thread = threading.Thread(target=self._run, daemon=True)
-        self.thread.start()
+        for shard in self.shards:
+            if shard.figis:
+                shard.start()
     def stop(self):
-        self.running = False
+        for shard in self.shards:
+            shard.stop()
     def restart(self):
         self.stop()
-        if self.figi_to_orderbook:
-            self.start()
-    def _run(self):
-        asyncio.run(self._async_stream())
-    async def _async_stream(self):
-        try:
-            async with AsyncClient(self.token) as client:
-                figis = list(self.figi_to_orderbook.keys())
-                async def request_iterator():
-                    yield MarketDataRequest(
-                        subscribe_order_book_request=SubscribeOrderBookRequest(
-                            subscription_action=SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE,
-                            instruments=[OrderBookInstrument(instrument_id=figi, depth=50) for figi in figis]
-                        )
-                    )
-                    yield MarketDataRequest(
-                        subscribe_trades_request=SubscribeTradesRequest(
-                            subscription_action=SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE,
-                            instruments=[TradeInstrument(instrument_id=figi) for figi in figis]
-                        )
-                    )
-                    while self.running:
-                        await asyncio.sleep(0.1)
-                        yield MarketDataRequest()
-                stream = client.market_data_stream.market_data_stream(request_iterator())
-                async for response in stream:
-                    if not self.running:
-                        break
-                    # Определяем FIGI
-                    figi = None
-                    if hasattr(response, 'orderbook') and response.orderbook is not None:
-                        figi = response.orderbook.figi
-                    elif hasattr(response, 'trade') and response.trade is not None:
-                        figi = response.trade.figi
-                    if figi and figi in self.figi_to_orderbook:
-                        data = {}
-                        if hasattr(response, 'orderbook') and response.orderbook is not None:
-                            order_book = response.orderbook
-                            asks = [(float(a.price.units) + a.price.nano / 1e9, a.quantity, 0) for a in order_book.asks]
-                            bids = [(float(b.price.units) + b.price.nano / 1e9, b.quantity, 0) for b in order_book.bids]
-                            data['bids'] = bids
-                            data['asks'] = asks
-                        if hasattr(response, 'trade') and response.trade is not None:
-                            trade = response.trade
-                            if trade.price is not None:
-                                trade_data = {
-                                    'price': float(trade.price.units) + trade.price.nano / 1e9,
-                                    'quantity': trade.quantity,
-                                    'direction': trade.direction
-                                }
-                                data['trade'] = trade_data
-                        if data:
-                            self.figi_to_orderbook[figi].data_from_stream.emit(data)
-        except Exception as e:
-            pass
+        old_shards = self.shards
+        # Устаревшие стаканы остаются устаревшими в новых шардах до первого снимка
+        stale = set().union(*(shard._stale for shard in old_shards))
+        self.shards = []
+        self._figi_to_shard = {}
+        for figi in list(self.figi_to_orderbook):
+            shard = self._shard_for_new_figi()
+            self._figi_to_shard[figi] = shard
+            shard.figis.add(figi)
+            if figi in stale:
+                shard._set_stale(figi, True)
+        # Новые шарды занимают те же номера и полосы; лишние полосы закрываются
+        used = {shard.index for shard in self.shards}
+        for shard in old_shards:
+            if shard.index not in used:
+                shard.close()
+        self.start()
+    def last_message_age(self):
+        ages = [age for age in (shard.last_message_age() for shard in self.shards) if age is not None]
+        return min(ages, default=None)
+    def stats(self):
+        shards = [shard.stats() for shard in self.shards]
+        return {
+            'running': self.running,
+            'shard_size': self.shard_size,
+            'recorder': self.recorder.stats() if self.recorder is not None else None,
+            'reconnect_count': self.reconnect_count,
+            'last_message_age': self.last_message_age(),
+            'stale': sorted(figi for shard in shards for figi in shard['stale']),
+            'shards': shards,
+        }
+    def _shard_for_new_figi(self):
+        for shard in self.shards:
+            if not self.shard_size or len(shard.figis) < self.shard_size:
+                return shard
+        # Наименьший свободный номер: полоса с этим номером (и её канал) переиспользуется
+        used = {shard.index for shard in self.shards}
+        index = next(i for i in range(len(used) + 1) if i not in used)
+        shard = MarketDataShard(self, index)
+        self.shards.append(shard)
+        return shard
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
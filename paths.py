@@ -0,0 +1,13 @@
+# Каталоги приложения на диске (XDG): данные — записи стрима, выгрузки задержек и профилей,
+# кэш — справочник инструментов. Модуль без Qt, его импортируют и фоновые инструменты.
+import os
+
+APP_NAME = 't-invest-dashboard'
+
+def data_dir(*parts):
+    base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, APP_NAME, *parts)
+
+def cache_dir(*parts):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, APP_NAME, *parts)
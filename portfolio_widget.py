@@ -1,57 +1,195 @@
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QTableWidget, QTableWidgetItem
 from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer
-from PyQt5.QtGui import QColor
-import threading
+from PyQt5.QtGui import QColor, QBrush
 import asyncio
+import time
 from google.protobuf.json_format import MessageToDict
+from connection_pool import ConnectionPool, reconnect_delay
+from profiler import label
+from prices import NANO, quotation_to_nanos, format_nanos
 try:
-    from tinkoff.invest import AsyncClient
     from tinkoff.invest.services import OperationsStreamService
 except ImportError:
-    AsyncClient = None
     OperationsStreamService = None
 
+def _field(value, name, default=None):
+    # Поле сообщения API: объект (protobuf/dataclass) или уже словарь
+    if isinstance(value, dict):
+        return value.get(name, default)
+    return getattr(value, name, default)
+
+def _nanos_or_none(value):
+    return quotation_to_nanos(value) if value else None
+
+def _round_cents(nanos):
+    # Знак значения после округления до сотых — тот, что будет виден в таблице
+    cents = (abs(nanos) + 5 * 10 ** 6) // 10 ** 7
+    return cents if nanos >= 0 else -cents
+
+class PositionRecord:
+    # Позиция портфеля в фиксированной точке (целые нано, см. prices.py): MoneyValue/Quotation
+    # переводятся один раз при разборе, стоимость, доход и доходность считаются в числах,
+    # строки появляются только при отображении (cells)
+    __slots__ = ('figi', 'ticker', 'instrument_type', 'quantity', 'average_price', 'average_currency',
+                 'current_price', 'current_currency')
+
+    def __init__(self, figi, ticker, instrument_type, quantity, average_price, average_currency,
+                 current_price, current_currency):
+        self.figi = figi
+        self.ticker = ticker
+        self.instrument_type = instrument_type
+        self.quantity = quantity            # нано или None, если поля нет
+        self.average_price = average_price  # нано или None
+        self.average_currency = average_currency
+        self.current_price = current_price
+        self.current_currency = current_currency
+
+    @classmethod
+    def from_api(cls, pos):
+        average = _field(pos, 'average_position_price')
+        current = _field(pos, 'current_price')
+        return cls(_field(pos, 'figi', '') or '', _field(pos, 'ticker', '') or '',
+                   _field(pos, 'instrument_type', '') or '', _nanos_or_none(_field(pos, 'quantity')),
+                   _nanos_or_none(average), _field(average, 'currency', '') or '' if average else '',
+                   _nanos_or_none(current), _field(current, 'currency', '') or '' if current else '')
+
+    def _key(self):
+        return (self.figi, self.ticker, self.instrument_type, self.quantity, self.average_price,
+                self.average_currency, self.current_price, self.current_currency)
+
+    def __eq__(self, other):
+        return isinstance(other, PositionRecord) and self._key() == other._key()
+
+    @property
+    def value(self):
+        # Стоимость позиции в нано; None, если нет количества или цены
+        if not self.quantity or not self.current_price:
+            return None
+        return self.quantity * self.current_price // NANO
+
+    @property
+    def profit(self):
+        if not self.quantity or not self.current_price or not self.average_price:
+            return None
+        return self.quantity * (self.current_price - self.average_price) // NANO
+
+    @property
+    def profit_percent(self):
+        profit = self.profit
+        if not profit:
+            return None
+        return profit * 100 * NANO / (self.average_price * self.quantity)
+
+    def cells(self):
+        # Ячейки строки таблицы и «тон» (знак) колонок дохода для цвета
+        profit = self.profit
+        percent = self.profit_percent
+        return (
+            (self.ticker or self.figi, self.instrument_type or '—',
+             self._format(self.quantity), self._format(self.average_price, self.average_currency),
+             self._format(self.current_price, self.current_currency),
+             format_nanos(profit) if profit else '—',
+             f"{percent:.2f}%" if percent is not None else '—'),
+            (self._tone(_round_cents(profit) if profit else 0), self._tone(round(percent, 2) if percent is not None else 0)),
+        )
+
+    @staticmethod
+    def _format(nanos, currency=''):
+        if nanos is None:
+            return '—'
+        text = format_nanos(nanos, grouping=False)
+        return f"{text} {currency}" if currency else text
+
+    @staticmethod
+    def _tone(value):
+        return (value > 0) - (value < 0)
+
 class PortfolioStreamWorker(QObject):
+    # Стрим портфеля с переподключением (экспоненциальная задержка с джиттером).
+    # reconnected — первое сообщение после переподключения: пока стрим лежал,
+    # изменения могли пройти мимо, и виджет сверяется через REST.
     data_updated = pyqtSignal(object)
     error = pyqtSignal(str)
+    reconnected = pyqtSignal()
+    RECONNECT_BASE_DELAY = 1.0  # секунды
+    RECONNECT_MAX_DELAY = 30.0
 
     def __init__(self, token, account_id):
         super().__init__()
         self.token = token
         self.account_id = account_id
         self.running = False
-        self.thread = None
+        self.reconnect_count = 0
+        self.message_count = 0
+        self._last_message_time = None
+        self._future = None
 
     def start(self):
+        # Стрим идёт по общей полосе пула подключений (тот же канал, что и REST-запросы)
         self.running = True
-        self.thread = threading.Thread(target=self._run, daemon=True)
-        self.thread.start()
+        self._future = ConnectionPool.lane(self.token).submit(self._async_stream())
 
     def stop(self):
         self.running = False
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
 
-    def _run(self):
-        asyncio.run(self._async_stream())
+    def last_message_age(self):
+        # Секунды с последнего сообщения стрима, включая пинги (None — сообщений ещё не было)
+        if self._last_message_time is None:
+            return None
+        return time.monotonic() - self._last_message_time
 
     async def _async_stream(self):
-        if AsyncClient is None:
-            self.error.emit("tinkoff.invest не установлен")
-            return
-        try:
-            async with AsyncClient(self.token) as client:
+        attempt = 0
+        while self.running:
+            received = False
+            try:
+                client = await ConnectionPool.lane(self.token).services()
                 async for item in client.operations_stream.portfolio_stream(accounts=[self.account_id]):
                     if not self.running:
                         break
-                    try:
-                        data = item.dict()
-                    except AttributeError:
-                        data = item.__dict__
-                    self.data_updated.emit(data)
-        except Exception as e:
-            self.error.emit(str(e))
+                    self._last_message_time = time.monotonic()
+                    self.message_count += 1
+                    if not received:
+                        received = True
+                        if self.reconnect_count:
+                            self.reconnected.emit()
+                    # Сообщение уходит как есть: позиции разбирает PositionRecord; пинги не нужны
+                    if _field(item, 'portfolio'):
+                        self.data_updated.emit(item)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.error.emit(str(e))
+            if not self.running:
+                break
+            attempt = 0 if received else attempt + 1
+            self.reconnect_count += 1
+            try:
+                await asyncio.sleep(reconnect_delay(attempt, self.RECONNECT_BASE_DELAY, self.RECONNECT_MAX_DELAY))
+            except asyncio.CancelledError:
+                break
 
 class PortfolioWidget(QWidget):
+    # Источник данных — стрим портфеля. REST-снимок запрашивается только для сверки:
+    # при открытии, после ошибки или переподключения стрима и при долгой тишине в стриме.
     rest_data_ready = pyqtSignal(object)
+    rest_error = pyqtSignal(str)
+
+    # Тишина в стриме (ни данных, ни пингов) дольше этого — возможен пропуск, сверяемся
+    STREAM_GAP_TIMEOUT = 180  # секунды
+    GAP_CHECK_INTERVAL = 5000  # мс
+
+    GROUPS = ('Валюта и металлы', 'Акции', 'Облигации', 'Фонды', 'Фьючерсы', 'Другое')
+    GROUP_BY_TYPE = {'currency': 'Валюта и металлы', 'metal': 'Валюта и металлы', 'share': 'Акции',
+                     'bond': 'Облигации', 'etf': 'Фонды', 'futures': 'Фьючерсы'}
+    GROUP_BG_COLOR = QColor('#232323')
+    GROUP_FG_COLOR = QColor('#C0C0C0')
+    PROFIT_BRUSH = QBrush(QColor('#98c379'))  # зелёный
+    LOSS_BRUSH = QBrush(QColor('#e06c75'))    # красный
+    TONE_BRUSHES = {1: PROFIT_BRUSH, -1: LOSS_BRUSH, 0: QBrush()}
 
     def __init__(self, token, account_id):
         super().__init__()
@@ -74,174 +212,144 @@ class PortfolioWidget(QWidget):
         self.table.setSelectionMode(QTableWidget.NoSelection)
         self.table.setEditTriggers(QTableWidget.NoEditTriggers)
         self.table.setSortingEnabled(False)
+        # --- Тёмный стиль (один раз, а не на каждое обновление) ---
+        self.table.setStyleSheet('''
+            QTableWidget { background: #181818; color: #C0C0C0; border: 1px solid #222; gridline-color: #333; }
+            QHeaderView::section { background: #232323; color: #C0C0C0; border: 1px solid #222; font-weight: bold; }
+            QTableWidget::item { padding: 2px; }
+        ''')
+        # Показанное состояние: позиции последнего снимка и строки таблицы (ключ, ячейки)
+        self._last_positions = None
+        self._rows = []
+        self._hidden_data = None  # последнее сообщение, пришедшее, пока окно скрыто
         self.token = token
         self.account_id = account_id
+        self.rest_requests = 0
+        self._rest_future = None
+        self._gap_checked_at = None  # message_count, при котором уже была сверка по тишине
         self.worker = PortfolioStreamWorker(token, account_id)
         self.worker.data_updated.connect(self.update_portfolio)
-        self.worker.error.connect(self.show_error)
-        self.worker.start()
-        # --- Таймер для периодического обновления через REST ---
+        self.worker.error.connect(self.on_stream_error)
+        self.worker.reconnected.connect(self.update_portfolio_rest)
         self.rest_data_ready.connect(self.update_portfolio)
-        self.rest_timer = QTimer(self)
-        self.rest_timer.setInterval(8000)  # 8 секунд
-        self.rest_timer.timeout.connect(self.update_portfolio_rest)
-        self.rest_timer.start()
-        self._rest_loop = asyncio.new_event_loop()
-        threading.Thread(target=self._run_rest_loop, daemon=True).start()
+        self.rest_error.connect(self.show_error)
+        # --- Сторож тишины: сам ничего не запрашивает, пока стрим жив ---
+        self.gap_timer = QTimer(self)
+        self.gap_timer.setInterval(self.GAP_CHECK_INTERVAL)
+        self.gap_timer.timeout.connect(self.check_stream_gap)
+        self.start_streaming()
 
-    def _run_rest_loop(self):
-        asyncio.set_event_loop(self._rest_loop)
-        self._rest_loop.run_forever()
+    def start_streaming(self):
+        # Стартовый снимок по REST, дальше — стрим
+        if not self.worker.running:
+            self.worker.start()
+            self.update_portfolio_rest()
+        self.gap_timer.start()
+
+    def on_stream_error(self, msg):
+        self.show_error(msg)
+        self.update_portfolio_rest()
+
+    def check_stream_gap(self):
+        age = self.worker.last_message_age()
+        if age is None or age < self.STREAM_GAP_TIMEOUT:
+            return
+        # Одна сверка на каждый период тишины
+        if self._gap_checked_at == self.worker.message_count:
+            return
+        self._gap_checked_at = self.worker.message_count
+        self.update_portfolio_rest()
 
     def update_portfolio_rest(self):
-        asyncio.run_coroutine_threadsafe(self._fetch_and_emit(), self._rest_loop)
+        # Запрос по уже открытому каналу полосы; пока предыдущий не завершён, новый не нужен
+        if self._rest_future is not None and not self._rest_future.done():
+            return
+        self.rest_requests += 1
+        self._rest_future = ConnectionPool.lane(self.token).submit(self._fetch_and_emit())
 
     async def _fetch_and_emit(self):
-        if AsyncClient is None:
-            return
         try:
-            async with AsyncClient(self.token) as client:
-                resp = await client.operations.get_portfolio(account_id=self.account_id)
-                try:
-                    data = resp.dict()
-                except Exception:
-                    data = resp.__dict__
-                self.rest_data_ready.emit({'portfolio': data})
+            client = await ConnectionPool.lane(self.token).services()
+            resp = await client.operations.get_portfolio(account_id=self.account_id)
+            self.rest_data_ready.emit({'portfolio': resp})
         except Exception as e:
-            self.show_error(f"REST: {e}")
+            self.rest_error.emit(f"REST: {e}")
 
+    @label('update_portfolio')
     def update_portfolio(self, data):
-        import json
-        # Если окно скрыто — не обновлять
+        # Если окно скрыто — не обновлять, но запомнить: стрим не повторит пропущенное
         if not self.isVisible():
+            self._hidden_data = data
             return
         # Если была ошибка, а теперь всё ок — убрать сообщение
         if hasattr(self, '_last_error') and self._last_error:
             self.label.setText("Портфель (обновляется в реальном времени)")
             self._last_error = None
-        # Преобразуем в dict, если это не dict
-        if not isinstance(data, dict):
-            try:
-                data = data.dict()
-            except AttributeError:
-                data = data.__dict__
-        portfolio = data.get('portfolio') or data.get('result', {}).get('portfolio')
+        # Сообщение стрима, ответ REST или словарь с теми же полями
+        portfolio = _field(data, 'portfolio') or _field(_field(data, 'result') or {}, 'portfolio')
         if not portfolio:
             return
-        if not isinstance(portfolio, dict):
-            try:
-                portfolio = portfolio.dict()
-            except AttributeError:
-                portfolio = portfolio.__dict__
-        positions = portfolio.get('positions', [])
-        self.table.setUpdatesEnabled(False)
+        positions = [PositionRecord.from_api(pos) for pos in _field(portfolio, 'positions') or []]
+        # Те же позиции, что и в прошлый раз, — таблицу не трогаем вовсе
+        if positions == self._last_positions:
+            return
+        self._last_positions = positions
+        self._apply_rows(self._build_rows(positions))
+
+    def _build_rows(self, positions):
+        # Строки таблицы: [(ключ, ячейки, тоны дохода)], ключ — ('group', название) или ('position', figi)
         # --- Группировка по типу инструмента ---
-        groups = {'Валюта и металлы': [], 'Акции': [], 'Облигации': [], 'Фонды': [], 'Фьючерсы': [], 'Другое': []}
+        groups = {group: [] for group in self.GROUPS}
         for pos in positions:
-            if not isinstance(pos, dict):
-                try:
-                    pos = pos.dict()
-                except AttributeError:
-                    pos = pos.__dict__
-            instr_type = pos.get('instrument_type', '').lower()
-            if instr_type in ('currency', 'metal'):
-                groups['Валюта и металлы'].append(pos)
-            elif instr_type == 'share':
-                groups['Акции'].append(pos)
-            elif instr_type == 'bond':
-                groups['Облигации'].append(pos)
-            elif instr_type == 'etf':
-                groups['Фонды'].append(pos)
-            elif instr_type == 'futures':
-                groups['Фьючерсы'].append(pos)
-            else:
-                groups['Другое'].append(pos)
-        # --- Считаем итоговое количество строк ---
-        rows = 0
-        for group, items in groups.items():
-            if items:
-                rows += 1 + len(items)  # строка группы + позиции
-        self.table.setRowCount(rows)
-        # --- Тёмный стиль ---
-        self.table.setStyleSheet('''
-            QTableWidget { background: #181818; color: #C0C0C0; border: 1px solid #222; gridline-color: #333; }
-            QHeaderView::section { background: #232323; color: #C0C0C0; border: 1px solid #222; font-weight: bold; }
-            QTableWidget::item { padding: 2px; }
-        ''')
-        row = 0
+            groups[self.GROUP_BY_TYPE.get(pos.instrument_type.lower(), 'Другое')].append(pos)
+        empty = ('',) * (self.table.columnCount() - 1)
+        rows = []
         for group, items in groups.items():
             if not items:
                 continue
-            # --- Строка группы ---
-            group_item = QTableWidgetItem(group)
-            group_item.setFlags(Qt.ItemIsEnabled)
-            group_item.setBackground(QColor('#232323'))
-            group_item.setForeground(QColor('#C0C0C0'))
-            self.table.setItem(row, 0, group_item)
-            for col in range(1, self.table.columnCount()):
-                empty = QTableWidgetItem('')
-                empty.setFlags(Qt.ItemIsEnabled)
-                empty.setBackground(QColor('#232323'))
-                empty.setForeground(QColor('#C0C0C0'))
-                self.table.setItem(row, col, empty)
-            row += 1
-            # --- Позиции ---
+            rows.append((('group', group), (group,) + empty, None))
             for pos in items:
-                if not isinstance(pos, dict):
-                    try:
-                        pos = pos.dict()
-                    except AttributeError:
-                        pos = pos.__dict__
-                ticker = pos.get('ticker', '') or pos.get('figi', '')
-                quantity = self._format_quota(pos.get('quantity')) or '—'
-                avg_price = self._format_money(pos.get('average_position_price')) or '—'
-                cur_price = self._format_money(pos.get('current_price')) or '—'
-                # --- Стоимость ---
-                try:
-                    q = float(quantity.replace(',', '.'))
-                except Exception:
-                    q = 0
-                try:
-                    cp = float(cur_price.split()[0].replace(',', '.'))
-                except Exception:
-                    cp = 0
-                value = q * cp if q and cp else ''
-                value_str = f"{value:,.2f}" if value else '—'
-                # --- Доход и доходность ---
-                try:
-                    ap = float(avg_price.split()[0].replace(',', '.'))
-                except Exception:
-                    ap = 0
-                profit = (cp - ap) * q if q and cp and ap else ''
-                profit_str = f"{profit:,.2f}" if profit else '—'
-                profit_pct = (profit / (ap * q) * 100) if profit and ap and q else ''
-                profit_pct_str = f"{profit_pct:.2f}%" if profit_pct != '' else '—'
-                # --- Заполнение строки ---
-                for j, val in enumerate([ticker, pos.get('instrument_type', '—'), quantity, avg_price, cur_price, profit_str, profit_pct_str]):
-                    item = QTableWidgetItem(val)
-                    item.setTextAlignment(Qt.AlignCenter)
-                    # Цвет для дохода и доходности
-                    if j in (5, 6):
-                        try:
-                            num = float(val.replace('%', '').replace(',', '.'))
-                            if num > 0:
-                                item.setForeground(QColor('#98c379'))  # зелёный
-                            elif num < 0:
-                                item.setForeground(QColor('#e06c75'))  # красный
-                        except Exception:
-                            pass
-                    self.table.setItem(row, j, item)
-                row += 1
-        # --- Очистить лишние строки, если их стало меньше ---
-        for r in range(row, self.table.rowCount()):
-            for c in range(self.table.columnCount()):
-                self.table.setItem(r, c, QTableWidgetItem(''))
-        self.table.setUpdatesEnabled(True)
-        # Сравниваем с предыдущим состоянием
-        new_data_str = json.dumps(data, sort_keys=True, default=str)
-        if hasattr(self, '_last_portfolio_data') and self._last_portfolio_data == new_data_str:
-            return  # Данные не изменились, не обновляем таблицу
-        self._last_portfolio_data = new_data_str
+                rows.append((('position', pos.figi or pos.ticker),) + pos.cells())
+        return rows
+
+    def _apply_rows(self, rows):
+        # Сравнение с тем, что уже показано: ячейки создаются один раз, дальше меняется
+        # только текст (и цвет дохода) там, где значение действительно изменилось
+        table = self.table
+        prev_rows = self._rows
+        table.setUpdatesEnabled(False)
+        if table.rowCount() != len(rows):
+            table.setRowCount(len(rows))
+        for row, (key, cells, tones) in enumerate(rows):
+            prev = prev_rows[row] if row < len(prev_rows) else None
+            if prev == (key, cells, tones):
+                continue
+            kind = key[0]
+            restyle = prev is None or prev[0][0] != kind
+            for col, text in enumerate(cells):
+                if not restyle and prev[1][col] == text:
+                    continue
+                item = table.item(row, col)
+                if restyle or item is None:
+                    item = self._new_item(kind)
+                    table.setItem(row, col, item)
+                item.setText(text)
+            # Цвет для дохода и доходности
+            if tones is not None and (restyle or prev[2] != tones):
+                for col, tone in zip((5, 6), tones):
+                    table.item(row, col).setForeground(self.TONE_BRUSHES[tone])
+        table.setUpdatesEnabled(True)
+        self._rows = rows
+
+    def _new_item(self, kind):
+        item = QTableWidgetItem()
+        if kind == 'group':
+            item.setFlags(Qt.ItemIsEnabled)
+            item.setBackground(self.GROUP_BG_COLOR)
+            item.setForeground(self.GROUP_FG_COLOR)
+        else:
+            item.setTextAlignment(Qt.AlignCenter)
+        return item
 
     def show_error(self, msg):
         # Показывать ошибку только если она новая или не INTERNAL
@@ -253,40 +361,14 @@ class PortfolioWidget(QWidget):
         else:
             self.label.setText(f"Ошибка: {msg}")
 
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.start_streaming()
+        if self._hidden_data is not None:
+            data, self._hidden_data = self._hidden_data, None
+            self.update_portfolio(data)
+
     def closeEvent(self, event):
         self.worker.stop()
-        self.rest_timer.stop()
+        self.gap_timer.stop()
         super().closeEvent(event)
-
-    def _format_money(self, money):
-        if not money:
-            return ''
-        if not isinstance(money, dict):
-            try:
-                money = money.dict()
-            except AttributeError:
-                money = money.__dict__
-        units = money.get('units', '0')
-        nano = money.get('nano', 0)
-        currency = money.get('currency', '')
-        try:
-            value = float(units) + int(nano) / 1e9
-        except Exception:
-            value = 0
-        return f"{value:.2f} {currency}" if currency else f"{value:.2f}"
-
-    def _format_quota(self, quota):
-        if not quota:
-            return ''
-        if not isinstance(quota, dict):
-            try:
-                quota = quota.dict()
-            except AttributeError:
-                quota = quota.__dict__
-        units = quota.get('units', '0')
-        nano = quota.get('nano', 0)
-        try:
-            value = float(units) + int(nano) / 1e9
-        except Exception:
-            value = 0
-        return f"{value:.2f}" 
\ No newline at end of file
@@ -0,0 +1,50 @@
+# Цены в фиксированной точке: целые нано-единицы (1e-9), как в Quotation/MoneyValue API.
+# Вся арифметика над ценами (тики, сравнения, суммы) идёт в целых числах,
+# в float/строку значение переводится только при отображении.
+from decimal import Decimal
+
+NANO = 1_000_000_000
+
+
+def quotation_to_nanos(value):
+    # Quotation/MoneyValue (units, nano), dict с теми же полями, число или строка -> целые нано
+    if value is None:
+        return 0
+    if isinstance(value, dict):
+        return int(value.get('units', 0) or 0) * NANO + int(value.get('nano', 0) or 0)
+    if hasattr(value, 'units') and hasattr(value, 'nano'):
+        return int(value.units) * NANO + int(value.nano)
+    if isinstance(value, int):
+        return value * NANO
+    try:
+        return int(Decimal(str(value)) * NANO)
+    except Exception:
+        return 0
+
+
+def step_decimals(step_nanos):
+    # Сколько знаков после запятой нужно, чтобы показать шаг цены без потерь
+    if step_nanos <= 0:
+        return 2
+    decimals = 9
+    while decimals > 0 and step_nanos % 10 == 0:
+        step_nanos //= 10
+        decimals -= 1
+    return decimals
+
+
+def price_decimals(step_nanos):
+    # Знаки для цен инструмента: не меньше двух, как и раньше, но и не меньше точности шага
+    return max(2, step_decimals(step_nanos))
+
+
+def format_nanos(nanos, decimals=2, grouping=True):
+    # Точное форматирование без промежуточного float: 123456780000000 -> '123,456.78'
+    scale = 10 ** (9 - decimals)
+    rounded = (abs(nanos) + scale // 2) // scale
+    whole, frac = divmod(rounded, 10 ** decimals)
+    sign = '-' if nanos < 0 and rounded else ''
+    text = f"{whole:,}" if grouping else str(whole)
+    if decimals:
+        text = f"{text}.{frac:0{decimals}d}"
+    return sign + text
@@ -0,0 +1,145 @@
+# Встроенный сэмплирующий профилировщик горячих путей.
+# Отдельный поток раз в INTERVAL снимает стеки главного (Qt) потока и потоков стрима через
+# sys._current_frames() и копит их в свёрнутом виде (collapsed stacks: «поток;модуль:функция;... N»),
+# который читают flamegraph.pl, speedscope и inferno.
+# Горячие функции помечаются декоратором label(): он только записывает код функции в реестр
+# и возвращает её без обёртки, так что выключенный профилировщик ничего не стоит.
+# Метка попадает в имя кадра («модуль:функция [метка]»), по меткам считается доля сэмплов.
+#
+#   python main.py --profile                  # с запуска до выхода
+#   Ctrl+Shift+P в главном окне               # включить / выключить и сохранить
+import os
+import sys
+import threading
+import time
+from paths import data_dir
+
+LABELS = {}  # code object: метка
+
+def label(name):
+    # Пометить функцию для атрибуции в профиле; вызов функции не меняется
+    def register(func):
+        LABELS[func.__code__] = name
+        return func
+    return register
+
+class SamplingProfiler:
+    INTERVAL = 0.005  # секунды между сэмплами
+    THREAD_PREFIXES = ('api-market-data-shard', 'market-replay')  # потоки стрима
+    MAX_DEPTH = 256
+    THREAD_REFRESH = 1.0  # как часто перечитывать список потоков, секунды
+
+    def __init__(self, interval=None):
+        self.interval = interval or self.INTERVAL
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self.thread = None
+        self._stacks = {}  # (имя потока, (code, ...)): число сэмплов
+        self._names = {}  # code: строка кадра
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.samples = 0
+        self._stacks = {}
+        self._stop.clear()
+        self.started_at = time.time()
+        self.stopped_at = None
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self.thread.join()
+        self.thread = None
+        self.stopped_at = time.time()
+
+    def _watched_threads(self):
+        # ident -> имя: главный поток и потоки стрима
+        main = threading.main_thread()
+        watched = {main.ident: 'main'}
+        for thread in threading.enumerate():
+            if thread.name.startswith(self.THREAD_PREFIXES):
+                watched[thread.ident] = thread.name
+        return watched
+
+    def _run(self):
+        stacks = self._stacks
+        max_depth = self.MAX_DEPTH
+        watched = {}
+        refreshed = 0.0
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            if now - refreshed >= self.THREAD_REFRESH:
+                watched = self._watched_threads()
+                refreshed = now
+            for ident, frame in sys._current_frames().items():
+                name = watched.get(ident)
+                if name is None:
+                    continue
+                codes = []
+                while frame is not None and len(codes) < max_depth:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                key = (name, tuple(codes))
+                stacks[key] = stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def _frame_name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            name = f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+            if code in LABELS:
+                name = f"{name} [{LABELS[code]}]"
+            name = self._names[code] = name.replace(';', ':')
+        return name
+
+    def collapsed(self):
+        # -> {"поток;корень;...;лист": сэмплы}; стек снят от листа к корню, пишется от корня
+        result = {}
+        for (thread, codes), count in list(self._stacks.items()):
+            line = ';'.join([thread] + [self._frame_name(code) for code in reversed(codes)])
+            result[line] = result.get(line, 0) + count
+        return result
+
+    def label_shares(self):
+        # -> {поток: {метка: доля сэмплов потока, в стеке которых есть метка}}
+        totals = {}
+        hits = {}
+        for (thread, codes), count in list(self._stacks.items()):
+            totals[thread] = totals.get(thread, 0) + count
+            for name in {LABELS[code] for code in codes if code in LABELS}:
+                thread_hits = hits.setdefault(thread, {})
+                thread_hits[name] = thread_hits.get(name, 0) + count
+        return {thread: {name: round(count / totals[thread], 4) for name, count in sorted(labels.items())}
+                for thread, labels in hits.items()}
+
+    def write(self, path=None):
+        path = path or os.path.join(data_dir(), time.strftime('profile-%Y%m%d-%H%M%S.collapsed'))
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            for line, count in sorted(self.collapsed().items()):
+                f.write(f"{line} {count}\n")
+        return path
+
+    def summary(self):
+        duration = (self.stopped_at or time.time()) - self.started_at if self.started_at else 0
+        return {
+            'samples': self.samples,
+            'duration': round(duration, 2),
+            'interval': self.interval,
+            'labels': self.label_shares(),
+        }
+
+PROFILER = SamplingProfiler()
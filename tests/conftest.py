@@ -0,0 +1,10 @@
+# Тесты запускаются из корня репозитория: python -m pytest tests
+# Модули приложения лежат в корне, а не в пакете, поэтому корень добавляется в sys.path.
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
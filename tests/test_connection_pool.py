@@ -0,0 +1,12 @@
+# Общая задержка переподключения стримов (connection_pool.reconnect_delay)
+import random
+
+from connection_pool import reconnect_delay
+
+def test_reconnect_delay_grows_with_jitter():
+    random.seed(1)
+    for attempt, full in ((0, 0.5), (1, 1.0), (3, 4.0), (10, 30.0)):
+        delays = [reconnect_delay(attempt, 0.5, 30.0) for _ in range(200)]
+        # Джиттер только на вторую половину: не меньше половины и не больше полной задержки
+        assert all(full / 2 <= delay <= full for delay in delays)
+        assert max(delays) - min(delays) > full / 4
@@ -0,0 +1,258 @@
+# MarketDataShard против подставного market_data_stream: обрыв со стороны сервера,
+# переподключение с переподпиской, пометка устаревших стаканов и счётчики шарда.
+# Клиент API подменяется в connection_pool (AsyncClient), сеть не нужна.
+import asyncio
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('tinkoff.invest')
+grpc = pytest.importorskip('grpc')
+from grpc.aio import AioRpcError, Metadata
+
+import connection_pool
+from connection_pool import ConnectionPool
+from order_book_copy import LadderBuilder, MarketDataShard, StreamManager
+from prices import NANO
+
+STEP = NANO // 100  # шаг цены 0.01
+SUBSCRIBE = 1  # SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE
+
+CLOSE = object()  # сервер штатно закрывает стрим
+
+def level(price, quantity):
+    return SimpleNamespace(price=SimpleNamespace(units=price, nano=0), quantity=quantity)
+
+def order_book(figi, bid=100, ask=101):
+    return SimpleNamespace(orderbook=SimpleNamespace(figi=figi, depth=50, time=None,
+                                                     bids=[level(bid, 5)], asks=[level(ask, 7)]),
+                           trade=None)
+
+def server_error(details="RST_STREAM"):
+    return AioRpcError(grpc.StatusCode.UNAVAILABLE, Metadata(), Metadata(), details=details)
+
+class FakeServer:
+    # Ответы сервера идут из общей очереди feed в тот стрим, который сейчас открыт:
+    # объект ответа отдаётся клиенту, исключение обрывает стрим, CLOSE закрывает его штатно.
+    # Пока очередь пуста, стрим висит открытым, как живой стрим без данных.
+    def __init__(self, *feed, connect_errors=0):
+        self.feed = deque(feed)
+        self.connect_errors = connect_errors
+        self.connects = 0
+        self.subscriptions = []  # на каждый открытый стрим: множество подписанных FIGI
+
+    def push(self, *items):
+        # Вызывается из потока теста; deque.append потокобезопасен
+        self.feed.extend(items)
+
+    def client(self):
+        server = self
+
+        class FakeAsyncClient:
+            def __init__(self, token, **kwargs):
+                self.token = token
+
+            async def __aenter__(self):
+                server.connects += 1
+                if server.connect_errors:
+                    server.connect_errors -= 1
+                    raise server_error("connection refused")
+                return SimpleNamespace(market_data_stream=SimpleNamespace(market_data_stream=server.stream))
+
+            async def __aexit__(self, *exc_info):
+                return False
+
+        return FakeAsyncClient
+
+    async def stream(self, requests):
+        subscribed = set()
+        self.subscriptions.append(subscribed)
+
+        async def consume():
+            async for request in requests:
+                subscribe = getattr(request, 'subscribe_order_book_request', None)
+                if subscribe is None:
+                    continue
+                figis = {instrument.instrument_id for instrument in subscribe.instruments}
+                if subscribe.subscription_action == SUBSCRIBE:
+                    subscribed.update(figis)
+                else:
+                    subscribed.difference_update(figis)
+
+        consumer = asyncio.ensure_future(consume())
+        try:
+            await asyncio.sleep(0.01)  # запросы подписки доходят до «сервера» раньше данных
+            while True:
+                if not self.feed:
+                    await asyncio.sleep(0.005)
+                    continue
+                item = self.feed.popleft()
+                if item is CLOSE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            consumer.cancel()
+
+class Signal:
+    def __init__(self):
+        self.values = []
+
+    def emit(self, value):
+        self.values.append(value)
+
+class BookWindow:
+    price_step_nanos = STEP
+    lot_size = 1
+
+    def __init__(self):
+        self.data_from_stream = Signal()
+        self.stale_changed = Signal()
+
+def wait_until(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+@pytest.fixture
+def start_shard(monkeypatch, request):
+    monkeypatch.setattr(MarketDataShard, 'RECONNECT_BASE_DELAY', 0.01)
+    shards = []
+
+    def start(server, figis):
+        monkeypatch.setattr(connection_pool, 'AsyncClient', server.client())
+        manager = SimpleNamespace(token=f"test-{request.node.name}", recorder=None,
+                                  figi_to_orderbook={}, ladder_builders={})
+        for figi in figis:
+            manager.figi_to_orderbook[figi] = BookWindow()
+            manager.ladder_builders[figi] = LadderBuilder(STEP, 1)
+        shard = MarketDataShard(manager, 0)
+        shards.append(shard)
+        for figi in figis:
+            shard.add(figi)
+        return shard
+
+    yield start
+    for shard in shards:
+        shard.close()
+    ConnectionPool.close_all()
+
+def book(shard, figi):
+    return shard.manager.figi_to_orderbook[figi]
+
+def test_snapshot_is_built_into_frame(start_shard):
+    server = FakeServer(order_book('A'))
+    shard = start_shard(server, ['A'])
+    assert wait_until(lambda: book(shard, 'A').data_from_stream.values)
+    frame = book(shard, 'A').data_from_stream.values[0]
+    assert frame.markers[:2] == (101 * NANO // STEP, 100 * NANO // STEP)  # лучший ask, лучший bid
+    assert server.subscriptions == [{'A'}]
+    assert shard.reconnect_count == 0
+    assert book(shard, 'A').stale_changed.values == []
+
+def test_server_error_reconnects_and_resubscribes(start_shard):
+    server = FakeServer(order_book('A'), server_error())
+    shard = start_shard(server, ['A', 'B'])
+    assert wait_until(lambda: len(server.subscriptions) == 2)
+    assert wait_until(lambda: server.subscriptions[1] == {'A', 'B'})
+    assert shard.reconnect_count == 1
+    assert "RST_STREAM" in shard.last_error
+    assert server.connects == 1  # канал полосы переживает переподключение стрима
+    server.push(order_book('B'))
+    assert wait_until(lambda: book(shard, 'B').data_from_stream.values)
+
+def test_reconnect_subscribes_only_current_figis(start_shard):
+    server = FakeServer()
+    shard = start_shard(server, ['A', 'B'])
+    assert wait_until(lambda: server.subscriptions and server.subscriptions[0] == {'A', 'B'})
+    # Отписка идёт сообщением в открытый стрим, без переподключения
+    shard.remove('B')
+    assert wait_until(lambda: server.subscriptions[0] == {'A'})
+    assert len(server.subscriptions) == 1
+    server.push(server_error())
+    assert wait_until(lambda: len(server.subscriptions) == 2)
+    assert wait_until(lambda: server.subscriptions[1] == {'A'})
+    assert shard.reconnect_count == 1
+
+def test_stale_until_first_snapshot(start_shard):
+    server = FakeServer(order_book('A'), server_error())
+    shard = start_shard(server, ['A', 'B'])
+    assert wait_until(lambda: book(shard, 'A').stale_changed.values == [True])
+    assert wait_until(lambda: book(shard, 'B').stale_changed.values == [True])
+    assert shard.stats()['stale'] == ['A', 'B']
+    # Штатное закрытие без данных: стаканы остаются устаревшими, True повторно не шлётся
+    server.push(CLOSE)
+    assert wait_until(lambda: shard.reconnect_count == 2)
+    assert shard.last_error == "stream closed by server"
+    assert book(shard, 'A').stale_changed.values == [True]
+    # Первый снимок снимает пометку только со своего стакана
+    server.push(order_book('A'))
+    assert wait_until(lambda: book(shard, 'A').stale_changed.values == [True, False])
+    assert book(shard, 'B').stale_changed.values == [True]
+    assert shard.stats()['stale'] == ['B']
+
+def test_connect_error_counts_reconnect(start_shard):
+    server = FakeServer(order_book('A'), connect_errors=2)
+    shard = start_shard(server, ['A'])
+    assert wait_until(lambda: book(shard, 'A').data_from_stream.values)
+    assert server.connects == 3
+    assert shard.reconnect_count == 2
+    assert "connection refused" in shard.last_error
+
+def test_backoff_grows_until_data_arrives(start_shard, monkeypatch):
+    attempts = []
+    original = MarketDataShard._reconnect_delay
+
+    def record(self, attempt):
+        attempts.append(attempt)
+        return original(self, attempt)
+
+    monkeypatch.setattr(MarketDataShard, '_reconnect_delay', record)
+    server = FakeServer(server_error(), server_error(), order_book('A'), server_error())
+    shard = start_shard(server, ['A'])
+    assert wait_until(lambda: len(attempts) == 3)
+    # Два обрыва без данных увеличивают задержку, обрыв после данных сбрасывает её
+    assert attempts == [1, 2, 0]
+    assert shard.reconnect_count == 3
+
+def test_last_message_age(start_shard):
+    server = FakeServer()
+    shard = start_shard(server, ['A'])
+    assert wait_until(lambda: server.subscriptions)
+    assert shard.last_message_age() is None
+    server.push(order_book('A'))
+    assert wait_until(lambda: shard.last_message_age() is not None)
+    first = shard.last_message_age()
+    assert 0 <= first < 1
+    time.sleep(0.05)
+    assert shard.last_message_age() >= first + 0.04
+    assert shard.stats()['last_message_age'] >= first
+
+def test_restart_keeps_books_stale_until_snapshot(monkeypatch):
+    monkeypatch.setattr(MarketDataShard, 'RECONNECT_BASE_DELAY', 0.01)
+    monkeypatch.setattr(StreamManager, '_instance', None)
+    server = FakeServer(order_book('A'), server_error())
+    monkeypatch.setattr(connection_pool, 'AsyncClient', server.client())
+    manager = StreamManager('test-restart')
+    books = {figi: BookWindow() for figi in ('A', 'B')}
+    try:
+        for figi, window in books.items():
+            manager.register(figi, window)
+        assert wait_until(lambda: books['B'].stale_changed.values == [True])
+        # Перераспределение по шардам: новый стрим, а стакан B всё ещё без снимка
+        manager.restart()
+        assert manager.stats()['stale'] == ['A', 'B']
+        server.push(order_book('B'))
+        assert wait_until(lambda: books['B'].stale_changed.values == [True, False])
+        assert manager.stats()['stale'] == ['A']
+    finally:
+        for figi in list(books):
+            manager.unregister(figi)
+        ConnectionPool.close_all()
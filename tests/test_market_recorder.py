@@ -0,0 +1,49 @@
+# Заголовок сегментов записи стрима: шаг цены и лот FIGI (market_recorder.py)
+import os
+import time
+from array import array
+from types import SimpleNamespace
+
+from market_recorder import MAGIC, SEGMENT_HEADER, MarketRecorder
+
+def snapshot(bid, ask):
+    return SimpleNamespace(bid_count=1, ask_count=1,
+                           bid_prices=array('q', [bid]), bid_quantities=array('q', [5]),
+                           ask_prices=array('q', [ask]), ask_quantities=array('q', [7]))
+
+def headers(directory, figi):
+    result = []
+    for name in sorted(os.listdir(os.path.join(directory, figi))):
+        with open(os.path.join(directory, figi, name), 'rb') as f:
+            data = f.read()
+        magic, step, lot, name_size = SEGMENT_HEADER.unpack_from(data, 0)
+        result.append((magic, step, lot, data[SEGMENT_HEADER.size:SEGMENT_HEADER.size + name_size].decode()))
+    return result
+
+def test_segment_header_carries_step_and_lot(tmp_path):
+    recorder = MarketRecorder(str(tmp_path))
+    recorder.register('BBG000B9XRY4', 10_000_000, 10)
+    recorder.record_order_book('BBG000B9XRY4', snapshot(100_000_000_000, 100_010_000_000))
+    recorder.record_trade('BBG000B9XRY4', 100_000_000_000, 3, 1)
+    recorder.close()
+    assert headers(str(tmp_path), 'BBG000B9XRY4') == [(MAGIC, 10_000_000, 10, 'BBG000B9XRY4')]
+    assert recorder.records == 2
+
+def test_unregistered_figi_has_unknown_step(tmp_path):
+    recorder = MarketRecorder(str(tmp_path))
+    recorder.record_trade('FIGI', 1, 1, 1)
+    recorder.close()
+    assert headers(str(tmp_path), 'FIGI') == [(MAGIC, 0, 0, 'FIGI')]
+
+def test_changed_step_starts_new_segment(tmp_path):
+    recorder = MarketRecorder(str(tmp_path))
+    recorder.FLUSH_INTERVAL = 0.01
+    recorder.register('FIGI', 10_000_000, 1)
+    recorder.record_trade('FIGI', 1, 1, 1)
+    deadline = time.monotonic() + 3
+    while recorder.records < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    recorder.register('FIGI', 5_000_000, 1)
+    recorder.record_trade('FIGI', 1, 1, 1)
+    recorder.close()
+    assert [header[1] for header in headers(str(tmp_path), 'FIGI')] == [10_000_000, 5_000_000]
@@ -0,0 +1,71 @@
+# Чтение сегментов записи: шаг цены и лот из заголовка (market_replay.py)
+import pytest
+
+pytest.importorskip('PyQt5')
+pytest.importorskip('tinkoff.invest')
+
+import instrument_cache
+from instrument_cache import InstrumentInfo, save_cache
+from market_recorder import MarketRecorder
+from market_replay import instrument_steps, open_tracks
+from order_book_copy import BookSnapshot, LadderBuilder, LadderFrame, TradeTick
+from prices import NANO
+
+STEP = NANO // 200  # 0.005
+
+def book(bid, ask):
+    return BookSnapshot().set_levels([(bid, 5, None)], [(ask, 7, None)])
+
+def test_step_and_lot_from_header(tmp_path):
+    recorder = MarketRecorder(str(tmp_path))
+    recorder.register('FIGI', STEP, 10)
+    recorder.record_order_book('FIGI', book(100 * NANO, 100 * NANO + 2 * STEP))
+    recorder.record_trade('FIGI', 100 * NANO, 3, 1)
+    recorder.close()
+    track = open_tracks(str(tmp_path))['FIGI']
+    try:
+        assert (track.price_step_nanos, track.lot_size) == (STEP, 10)
+    finally:
+        track.close()
+
+def test_other_magic_is_rejected(tmp_path):
+    figi_dir = tmp_path / 'FIGI'
+    figi_dir.mkdir()
+    (figi_dir / f"{1:020d}.seg").write_bytes(b'NOTASEG0' + bytes(64))
+    assert open_tracks(str(tmp_path)) == {}
+
+def test_unregistered_step_comes_from_instrument_cache(tmp_path, monkeypatch):
+    recorder = MarketRecorder(str(tmp_path / 'rec'))
+    recorder.record_trade('CACHED', 100 * NANO, 3, 1)
+    recorder.record_trade('UNKNOWN', 100 * NANO, 3, 1)
+    recorder.close()
+    cache = str(tmp_path / 'instruments.json')
+    save_cache([InstrumentInfo('SBER', 'TQBR', 'CACHED', 10, STEP, True)], cache)
+    monkeypatch.setattr(instrument_cache, 'cache_path', lambda: cache)
+    tracks = open_tracks(str(tmp_path / 'rec'))
+    try:
+        assert tracks['CACHED'].price_step_nanos == 0
+        # Без шага в записи и в кэше FIGI не воспроизводится
+        assert instrument_steps(tracks) == {'CACHED': (STEP, 10)}
+    finally:
+        for track in tracks.values():
+            track.close()
+
+def test_frames_are_read_back(tmp_path):
+    recorder = MarketRecorder(str(tmp_path))
+    recorder.register('FIGI', STEP, 1)
+    recorder.record_order_book('FIGI', book(100 * NANO, 100 * NANO + STEP), timestamp_ns=10)
+    recorder.record_trade('FIGI', 100 * NANO, 3, 1, timestamp_ns=20)
+    recorder.close()
+    track = open_tracks(str(tmp_path))['FIGI']
+    try:
+        track.builder = LadderBuilder(track.price_step_nanos, track.lot_size)
+        frame = track.read()
+        assert isinstance(frame, LadderFrame)
+        assert frame.markers[:2] == ((100 * NANO + STEP) // STEP, 100 * NANO // STEP)
+        track.advance()
+        trade = track.read()
+        assert isinstance(trade, TradeTick)
+        assert (trade.price, trade.quantity, trade.direction) == (100 * NANO, 3, 1)
+    finally:
+        track.close()
@@ -0,0 +1,17 @@
+# Каталоги данных и кэша (paths.py)
+import os
+
+from paths import cache_dir, data_dir
+
+def test_xdg_directories(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmp_path / 'data'))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    assert data_dir('recordings') == str(tmp_path / 'data' / 't-invest-dashboard' / 'recordings')
+    assert cache_dir('instruments.json') == str(tmp_path / 'cache' / 't-invest-dashboard' / 'instruments.json')
+
+def test_home_fallback(monkeypatch, tmp_path):
+    monkeypatch.delenv('XDG_DATA_HOME', raising=False)
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert data_dir() == os.path.join(str(tmp_path), '.local', 'share', 't-invest-dashboard')
+    assert cache_dir() == os.path.join(str(tmp_path), '.cache', 't-invest-dashboard')